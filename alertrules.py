@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+import logging
+from bisect import bisect_right
+
+from twobitbot import utils
+from twobitbot.tradewindow import TradeBuffer, TradeWindow
+from twobitbot.utils.quantile import RollingQuantiles
+
+log = logging.getLogger(__name__)
+
+
+class AlertRule(object):
+    """Alert when more than threshold BTC of market orders happen within window seconds,
+    at least dominance of it on one side."""
+
+    def __init__(self, window, threshold, dominance=0.8, name=None):
+        """
+        :param window: window length in seconds
+        :param threshold: minimum one-sided BTC volume in the window
+        :param dominance: minimum fraction of the window volume that has to be on that side
+        :param name: label for the rule in alerts, defaults to the window length e.g. '5m'
+        """
+        self.window = window
+        self.threshold = threshold
+        self.dominance = dominance
+        if name is None:
+            name = "{}m".format(window // 60) if window % 60 == 0 else "{}s".format(window)
+        self.name = name
+
+    def __repr__(self):
+        return "AlertRule(window={}, threshold={}, dominance={}, name={!r})".format(
+            self.window, self.threshold, self.dominance, self.name)
+
+
+class AlertTiers(object):
+    """Volume tier labels, e.g. 100+ BTC is a Tuna and 250+ a Dolphin."""
+
+    def __init__(self, tiers=None):
+        """
+        :param tiers: dict or list of pairs of label -> minimum BTC volume
+        """
+        if hasattr(tiers, 'items'):
+            tiers = tiers.items()
+        tiers = sorted((volume, label) for label, volume in (tiers or ()))
+        self.thresholds = [volume for volume, _ in tiers]
+        self.labels = [label for _, label in tiers]
+
+    def __len__(self):
+        return len(self.thresholds)
+
+    def label(self, volume):
+        """Return the label of the highest tier volume reaches, or None if it is below every tier."""
+        i = bisect_right(self.thresholds, volume)
+        return self.labels[i - 1] if i else None
+
+
+class AdaptiveThresholds(object):
+    """
+    Alert thresholds derived from a percentile of recent trade sizes and window volumes,
+    instead of fixed BTC amounts, so they follow how busy the market is.
+
+    Distributions are tracked with streaming quantile estimators, so memory is constant and observing is O(1).
+    """
+    reported_percentiles = (50, 90, 99)
+
+    def __init__(self, percentile, horizon=24*60*60, floor=0, min_samples=500):
+        """
+        :param percentile: percentile of the distribution to alert above, e.g. 99.9
+        :param horizon: how many seconds of trades the distributions are estimated over
+        :param floor: thresholds never go below this many BTC
+        :param min_samples: until this many observations are in, the static thresholds are used
+        """
+        self.percentile = percentile
+        self.horizon = horizon
+        self.floor = floor
+        self.min_samples = min_samples
+        self._percentiles = tuple(sorted(set(self.reported_percentiles + (percentile,))))
+
+        self.trade_sizes = self._new_estimator()
+        # one per rule, set up by track_windows
+        self.window_volumes = list()
+
+    def track_windows(self, count):
+        """Start estimating window volumes for count rules."""
+        self.window_volumes = [self._new_estimator() for _ in xrange(count)]
+
+    def observe_trade(self, amount, timestamp):
+        self.trade_sizes.add(amount, timestamp)
+
+    def trade_threshold(self, static):
+        """Threshold for single trades, or static if there isn't enough data yet."""
+        return self._threshold(self.trade_sizes, static)
+
+    def window_threshold(self, i, static):
+        """Threshold for the window of rule i, or static if there isn't enough data yet."""
+        return self._threshold(self.window_volumes[i], static)
+
+    def _threshold(self, estimator, static):
+        if estimator.count < self.min_samples:
+            return static
+        return max(self.floor, estimator.value(self.percentile))
+
+    def _new_estimator(self):
+        return RollingQuantiles(self._percentiles, self.horizon * 1000)
+
+    def describe(self, estimator):
+        """Summarize the estimated distribution of an estimator as a string."""
+        return u"{} (n={})".format(u" ".join(u"p{} {}".format(utils.truncatefloat(pct, decimals=1),
+                                                                  utils.truncatefloat(estimator.value(pct) or 0))
+                                              for pct in self._percentiles), estimator.count)
+
+
+class AlertRules(object):
+    """
+    Evaluates a set of AlertRules against the trade stream in one incremental pass.
+
+    Every rule has its own TradeWindow, but all windows share one TradeBuffer, so a trade is stored once
+    and each rule costs O(1) amortized per trade. There are no rescans of the trades, however many rules there are.
+    """
+
+    def __init__(self, rules, tiers=None, capacity=4096, adaptive=None):
+        """
+        :param rules: list of AlertRule
+        :param tiers: labels to attach to alerts
+        :type tiers: AlertTiers
+        :param adaptive: if set, rule thresholds follow the distribution of window volumes instead
+        :type adaptive: AdaptiveThresholds
+        """
+        self.rules = list(rules)
+        self.tiers = tiers if tiers is not None else AlertTiers()
+        self.trades = TradeBuffer(capacity)
+        self.windows = [TradeWindow(rule.window * 1000, buffer=self.trades) for rule in self.rules]
+        self.adaptive = adaptive
+        if adaptive:
+            adaptive.track_windows(len(self.rules))
+
+    def threshold(self, i):
+        """Current threshold of rule i."""
+        if self.adaptive:
+            return self.adaptive.window_threshold(i, self.rules[i].threshold)
+        return self.rules[i].threshold
+
+    def add(self, amount, price, is_buy, timestamp):
+        """
+        Add a trade and evaluate every rule.
+
+        :param timestamp: trade time in ms
+        :return: list of alert dicts with 'amount', 'price', 'is_buy', 'rule' and 'label' keys
+        """
+        trades = self.trades
+        amount, price = float(amount), float(price)
+        seq = trades.push(amount, price, timestamp, is_buy)
+
+        alerts = list()
+        oldest = trades.tail
+        adaptive = self.adaptive
+        for i, (rule, window) in enumerate(zip(self.rules, self.windows)):
+            window.observe(seq, amount, price, timestamp, is_buy)
+            if adaptive:
+                adaptive.window_volumes[i].add(max(window.buyvol, window.sellvol), timestamp)
+                threshold = adaptive.window_threshold(i, rule.threshold)
+            else:
+                threshold = rule.threshold
+            # expiring trades can tip the other side over the dominance ratio too, so check both
+            if window.buyvol > threshold and window.ratio(True) > rule.dominance:
+                alerts.append(self._alert(rule, window.buyvol, window.high, True))
+                window.clear()
+            elif window.sellvol > threshold and window.ratio(False) > rule.dominance:
+                alerts.append(self._alert(rule, window.sellvol, window.low, False))
+                window.clear()
+            if window.start < oldest:
+                oldest = window.start
+
+        # release trades that no window needs anymore
+        trades.head = oldest
+        return alerts
+
+    def _alert(self, rule, volume, price, is_buy):
+        return {'amount': volume, 'price': price, 'is_buy': is_buy, 'rule': rule, 'label': self.tiers.label(volume)}
+
+    def clear(self):
+        for window in self.windows:
+            window.clear()
+        self.trades.clear()
+
+    def stats(self):
+        """Describe the current alert thresholds, and the estimated distributions behind them in adaptive mode."""
+        thresholds = u", ".join(u"{} {}".format(rule.name, utils.truncatefloat(self.threshold(i)))
+                                for i, rule in enumerate(self.rules))
+        if not self.adaptive:
+            return u"Alert thresholds (BTC): {}".format(thresholds)
+        adaptive = self.adaptive
+        windows = u" | ".join(u"{} volume {}".format(rule.name, adaptive.describe(adaptive.window_volumes[i]))
+                              for i, rule in enumerate(self.rules))
+        return u"Adaptive alerts at p{} | trade size {} | {} | thresholds (BTC): {}".format(
+            utils.truncatefloat(adaptive.percentile, decimals=1), adaptive.describe(adaptive.trade_sizes),
+            windows, thresholds)
+
+
+def rules_from_config(config):
+    """
+    Build the alert rules and tiers from the bot config.
+
+    Rules are read from the [alert_rules] section. If there isn't one, the single default rule is used:
+    volume_alert_threshold BTC within 15 seconds with 80% of it on one side.
+    Tiers are read from the [alert_tiers] section as label = minimum volume.
+
+    :rtype: tuple of (list of AlertRule, AlertTiers)
+    """
+    rules = list()
+    for name, section in config.get('alert_rules', {}).iteritems():
+        rules.append(AlertRule(section['window'], section['threshold'], section['dominance'], name))
+    if not rules:
+        rules.append(AlertRule(15, config['volume_alert_threshold'] or 100, 0.8))
+    tiers = AlertTiers(config.get('alert_tiers', {}))
+    return rules, tiers
+
+
+def adaptive_from_config(config):
+    """
+    Build the adaptive alert thresholds from the bot config.
+
+    :return: AdaptiveThresholds, or None if adaptive_alert_percentile is 0 (disabled)
+    """
+    if not config['adaptive_alert_percentile']:
+        return None
+    return AdaptiveThresholds(config['adaptive_alert_percentile'], horizon=config['adaptive_alert_horizon'],
+                              floor=config['adaptive_alert_floor'])
+
+
+def main():
+    pass
+
+
+if __name__ == '__main__':
+    main()
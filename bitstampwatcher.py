@@ -1,21 +1,22 @@
 #!/usr/bin/env python
 
-from twisted.internet import task
-
 import logging
-import copy
-from collections import deque
+from decimal import Decimal
+
+import treq
+from twisted.internet import defer, reactor, task
 
 from twobitbot import utils
+from twobitbot.alertrules import AlertRule, AlertRules
+from twobitbot.orderbook import OrderBook, PriceSnapshot, WallTracker
+from twobitbot.candles import CandleAggregator
+from twobitbot.tape import TapeRecorder
 from exchangelib import bitstamp
 
 log = logging.getLogger(__name__)
 
 
-# todo: replace dicts with trade objects
-# todo: move thresholds into config file
 # todo: add live_orders support
-# todo: add tracking for walls
 
 
 # temp class for integrating bitstampobserver
@@ -56,137 +57,166 @@ class BitstampAlerter(bitstamp.BitstampObserver):
 
 
 class BitstampWatcher(object):
-
-    def __init__(self, triggervolume=100):
+    # seconds without an order book update after which its prices are too stale to use
+    max_book_age = 60
+
+    def __init__(self, triggervolume=100, wallvolume=0, tape_dir='', api=None, clock=None, rules=None, tiers=None,
+                 adaptive=None):
+        """
+        triggervolume: minimum BTC volume of a single market order to alert on
+        rules: list of AlertRule for bursts of market orders, defaults to triggervolume within 15s, 80% one-sided
+        tiers: AlertTiers labelling alerts by volume
+        adaptive: AdaptiveThresholds to derive thresholds from recent trades instead, None to use static thresholds
+        wallvolume: minimum BTC resting at a price level to alert on it as a wall, 0 to disable wall alerts
+        tape_dir: directory to record trades and top of book changes to, empty to disable recording
+        api: data source with a listen(event, callback) method, defaults to Bitstamp's websocket API
+        clock: provider of seconds() used for all timestamps (e.g. task.Clock for replays), defaults to the reactor
+        """
         self.triggervolume = triggervolume or 100
+        self.clock = clock or reactor
 
-        self._highestbid = None
-        self._lowestask = None
-
-        self.recentorders = deque()
-        self.orderbook = dict()
-        self.last_orderbook = None
+        if not rules:
+            rules = [AlertRule(15, self.triggervolume, 0.8)]
+        self.alert_rules = AlertRules(rules, tiers, adaptive=adaptive)
+        self.adaptive = adaptive
+        self.orderbook = OrderBook()
+        # PriceSnapshot of the top of book, replaced on every order book update
+        self.price = None
+        self.candles = CandleAggregator()
 
         self.alert_cbs = list()
 
+        self.walls = WallTracker(self.orderbook, wallvolume, self._send_alert) if wallvolume else None
+
+        self.tape = None
+        self._last_quote = None
+        if tape_dir:
+            self.tape = TapeRecorder(tape_dir)
+            self.tape.start()
+            reactor.addSystemEventTrigger('before', 'shutdown', self.tape.stop)
+
         # was previously done with BitstampWSAPI and add_trade_listener/add_orderbook_listener
-        self.api = bitstamp.BitstampWebsocketAPI2()
+        self.api = api or bitstamp.BitstampWebsocketAPI2()
         self.api.listen('trade', self.on_trade)
         self.api.listen('orderbook', self.on_orderbook)
+        # todo subscribe on_orderbook_diff once exchangelib exposes Bitstamp's diff_order_book channel
         #self.api.add_liveorder_listener('')
 
-        self.checker = task.LoopingCall(self.check_whale_marketorder)
-        self.checker.start(10)
+    def snapshot(self):
+        """The latest PriceSnapshot of the order book, or None if there's no data or it's stale."""
+        price = self.price
+        if price is None or price.age(self.clock.seconds()) > self.max_book_age:
+            return None
+        return price
 
     @property
     def highestbid(self):
-        if self._keep_orderbook_fresh():
-            return self._highestbid
+        price = self.snapshot()
+        return price.bid if price else None
 
     @property
     def lowestask(self):
-        if self._keep_orderbook_fresh():
-            return self._lowestask
-
-    def _keep_orderbook_fresh(self):
-        """Check that the orderbook data is fresh.
-        Returns true if it is, or there isn't data, and false if it's stale."""
-        now = utils.now_in_utc_secs()
-        if self.last_orderbook and now - self.last_orderbook > 60:
-            # 60s+ since last orderbook
-            return False
-        else:
-            # either the orderbook callback hasn't triggered yet or we have fresh data
-            return True
-
-    def __del__(self):
-        if self.checker is not None:
-            self.checker.stop()
+        price = self.snapshot()
+        return price.ask if price else None
 
-    def _tag_trade_buysell(self, order):
-        bid = self.highestbid
-        ask = self.lowestask
+    def _now_ms(self):
+        return int(self.clock.seconds() * 1000)
 
-        if bid is None or ask is None:
-            return
+    def _trade_is_buy(self, price):
+        """Return True if a trade at price was a market buy, False if a sell, or None if unknown."""
+        top = self.snapshot()
+        if top is None:
+            return None
 
-        if order['price'] <= bid:
-            # order executed under or at bid, so it's a sell
-            order['is_buy'] = False
-        if order['price'] >= ask:
+        if price >= top.ask:
             # order executed at or above ask, so it's a buy
-            order['is_buy'] = True
+            return True
+        if price <= top.bid:
+            # order executed under or at bid, so it's a sell
+            return False
+        return None
 
     def on_trade(self, data):
         """Callback, called when new bitstamp trade events
-        Data persisted in self.bitstamp_recentorders"""
-        self._tag_trade_buysell(data)
-        if not 'is_buy' in data:
-           # short circuit if not tagged buy/sell
+        Data persisted in self.alert_rules"""
+        amount = data['amount']
+        price = data['price']
+        self.candles.add_trade(self._now_ms(), price, amount)
+        if self.walls:
+            self.walls.on_trade(price, amount)
+        is_buy = self._trade_is_buy(price)
+        if self.tape:
+            self.tape.record_trade(self._now_ms(), price, amount, is_buy)
+        if is_buy is None:
+            # short circuit if not tagged buy/sell
             return
-        if data['amount'] > self.triggervolume:
-            self.announce_whale_order(data)
+        triggervolume = self.triggervolume
+        if self.adaptive:
+            self.adaptive.observe_trade(amount, self._now_ms())
+            triggervolume = self.adaptive.trade_threshold(triggervolume)
+        if amount > triggervolume:
+            self.announce_whale_order({'amount': amount, 'price': price, 'is_buy': is_buy,
+                                       'label': self.alert_rules.tiers.label(amount)})
             log.debug("trade event alerting on Bitstamp order: %.2f @ %.2f, is_buy: %s" %
-                     (data['amount'], data['price'], data['is_buy']))
+                      (amount, price, is_buy))
         else:
-            data['timestamp'] = utils.now_in_ms()
-            self.recentorders.appendleft(data)
-
-    def _clear_old_trades(self, timelimit_ms=15000):
-        """This has to be called to get a time-limited view of recent trades.
-        Parameters:
-            timelimit_ms - removes all orders more than this many ms old, compared to the most recent order"""
-        if len(self.recentorders) > 0:
-            while self.recentorders[0]['timestamp'] - self.recentorders[-1]['timestamp'] > timelimit_ms:
-                self.recentorders.pop()
-
-    def check_whale_marketorder(self):
-        # Avoid race condition with _trade_event removing orders??? no sure if important
-        # Not sure if this is the best method to do so.
-        # May not be necessary now that I removed the recentorders.clear() call in there
-        self._clear_old_trades()
-        orders = copy.copy(self.recentorders)
-
-        ordersum = sum([order['amount'] for order in orders])
-
-        # this much btc or more to trigger an alert
-
-        if ordersum > self.triggervolume:
-            buyvol = sellvol = 0
-            high = low = 0
-
-            for order in orders:
-                if 'is_buy' in order and order['is_buy'] is True:
-                    buyvol += order['amount']
-                    if high == 0 or order['price'] > high:
-                        high = order['price']
-                elif 'is_buy' in order and order['is_buy'] is False:
-                    sellvol += order['amount']
-                    if low == 0 or order['price'] < low:
-                        low = order['price']
-
-            log.debug("ordersum %s, buyvol %s, sellvol %s, high %.2f, low %.2f" %
-                      (ordersum, buyvol, sellvol, high, low))
-            if buyvol > self.triggervolume and buyvol/(buyvol+sellvol) > 0.8:
-                self.announce_whale_order({'amount': buyvol, 'price': high, 'is_buy': True})
-                self.recentorders.clear()
-            elif sellvol > self.triggervolume and sellvol/(buyvol+sellvol) > 0.8:
-                self.announce_whale_order({'amount': sellvol, 'price': low, 'is_buy': False})
-                self.recentorders.clear()
+            self.check_whale_marketorder(amount, price, is_buy)
+
+    def check_whale_marketorder(self, amount, price, is_buy):
+        """Feed a trade to the alert rules and announce every rule it makes fire.
+        Called on every windowed trade, so alerts fire on the trade that crosses a threshold."""
+        for alert in self.alert_rules.add(amount, price, is_buy, self._now_ms()):
+            log.debug("alert rule {} fired: {}".format(alert['rule'], alert))
+            self.announce_whale_order(alert)
+
+    def price_summary(self):
+        """Rolling 24h price summary, see candles.RollingStats.summary."""
+        return self.candles.summary(self._now_ms())
+
+    def alert_stats(self):
+        """Describe the current alert thresholds."""
+        stats = self.alert_rules.stats()
+        if self.adaptive:
+            stats += u", single trade {}".format(
+                utils.truncatefloat(self.adaptive.trade_threshold(self.triggervolume)))
+        return stats
 
     def on_orderbook(self, data):
-        """Callback, called when new bitstamp orderbook data available"""
-        self.orderbook = data
+        """Callback, called when a full bitstamp orderbook snapshot is available. Resyncs self.orderbook."""
         if 'bids' in data and 'asks' in data and len(data['bids']) > 0 and len(data['asks']) > 0:
-            self._highestbid = data['bids'][0]['price']
-            self._lowestask = data['asks'][0]['price']
-            self.last_orderbook = utils.now_in_utc_secs()
+            self.orderbook.apply_snapshot(data['bids'], data['asks'])
+            self.price = self.orderbook.price_snapshot(self.clock.seconds())
+            self._record_quote()
         else:
             log.warn("Bad orderbook data in on_orderbook: %s" % (data))
 
+    def on_orderbook_diff(self, data):
+        """Callback for incremental orderbook updates. Levels with an amount of 0 are removed."""
+        if 'bids' in data and 'asks' in data:
+            self.orderbook.apply_diff(data['bids'], data['asks'])
+            self.price = self.orderbook.price_snapshot(self.clock.seconds())
+            self._record_quote()
+        else:
+            log.warn("Bad orderbook diff in on_orderbook_diff: %s" % (data))
+
+    def _record_quote(self):
+        """Record the top of book to the tape if it changed since it was last recorded."""
+        if not self.tape:
+            return
+        book = self.orderbook
+        if book.best_bid is None or book.best_ask is None:
+            return
+        quote = (book.best_bid, book.best_ask, book.bids[book.best_bid], book.asks[book.best_ask])
+        if quote != self._last_quote:
+            self._last_quote = quote
+            self.tape.record_quote(self._now_ms(), *quote)
+
     def announce_whale_order(self, data):
-        """Call with dict in form of {'amount': ordersize, 'price': orderprice}. Additional data in dict is ignored"""
+        """Call with dict in form of {'amount': ordersize, 'price': orderprice}. Optional keys are 'is_buy',
+        'label' (volume tier) and 'rule' (the AlertRule that fired). Additional data in dict is ignored"""
         ann_str = u"Bitstamp alert | "
+        if data.get('label'):
+            ann_str += u"{} | ".format(data['label'])
         if 'is_buy' in data:
             if data['is_buy'] is True:
                 ann_str += u'\u25B2 BUY '
@@ -198,6 +228,8 @@ class BitstampWatcher(object):
 
         amt_str = utils.truncatefloat(data['amount'])
         ann = u"%s %s BTC at $%0.2f" % (ann_str, amt_str, data['price'])
+        if data.get('rule') and len(self.alert_rules.rules) > 1:
+            ann += u" within {}".format(data['rule'].name)
         log.info(ann.encode('utf8'))
         # sendline won't accept unicode, but moved the encoding into the actual callbacks
         self._send_alert(ann)
@@ -205,17 +237,66 @@ class BitstampWatcher(object):
     def add_alert_callback(self, callback):
         self.alert_cbs.append(callback)
 
+    def remove_alert_callback(self, callback):
+        if callback in self.alert_cbs:
+            self.alert_cbs.remove(callback)
+
     def _send_alert(self, msg):
         for cb in self.alert_cbs:
             cb(msg)
 
 
-class Trade:
-    def __init__(self, amount=0, price=0, timestamp=None, is_buy=None):
-        self.amount = amount
-        self.price = price
-        self.timestamp = timestamp
-        self.is_buy = is_buy
+class BitstampTickerWatcher(object):
+    """
+    Top of book of another Bitstamp instrument, e.g. LTC/USD, polled from the REST ticker,
+    for the flair game to price flairs in it. Like BitstampWatcher, snapshot() is None while there's no fresh data.
+    """
+    ticker_url = "https://www.bitstamp.net/api/v2/ticker/{}/"
+
+    def __init__(self, instrument, interval=10, max_age=60, clock=None):
+        """
+        instrument: Bitstamp currency pair, e.g. 'ltcusd'
+        interval: seconds between polls
+        max_age: seconds after which a quote is too stale to use
+        clock: provider of seconds(), defaults to the reactor
+        """
+        self.instrument = instrument
+        self.interval = interval
+        self.max_age = max_age
+        self.clock = clock or reactor
+        # PriceSnapshot of the latest quote, the sequence number counts polls
+        self.price = None
+        self._poller = task.LoopingCall(self.poll)
+        self._poller.clock = self.clock
+
+    def start(self):
+        self._poller.start(self.interval)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        if self._poller.running:
+            self._poller.stop()
+
+    def snapshot(self):
+        price = self.price
+        if price is None or price.age(self.clock.seconds()) > self.max_age:
+            return None
+        return price
+
+    @defer.inlineCallbacks
+    def poll(self):
+        """Fetch the current bid and ask. Failures are logged, and the quote goes stale if they keep failing."""
+        try:
+            res = yield treq.get(self.ticker_url.format(self.instrument))
+            if res.code == 200:
+                data = yield treq.json_content(res)
+                bid, ask = Decimal(str(data['bid'])), Decimal(str(data['ask']))
+                self.price = PriceSnapshot(bid, ask, (bid + ask) / 2, self.clock.seconds(),
+                                           self.price.sequence + 1 if self.price else 0)
+            else:
+                log.warn("Bad HTTP status from the Bitstamp {} ticker: {}".format(self.instrument, res.code))
+        except Exception:
+            log.warn("Failed polling the Bitstamp {} ticker".format(self.instrument), exc_info=True)
 
 
 def main():
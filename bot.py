@@ -8,6 +8,7 @@ from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.words.protocols import irc
 
 from twobitbot.bitstampwatcher import BitstampWatcher
+from twobitbot.alertrules import rules_from_config, adaptive_from_config
 from twobitbot.utils import ratelimit, configure
 from twobitbot import botresponder
 
@@ -47,14 +48,16 @@ log = logging.getLogger("ircbot")
 
 
 class TwoBitBotIRC(irc.IRCClient):
-    def __init__(self, config):
+    def __init__(self, config, bitstamp, responder):
         self.config = config
-
-        self.bitstamp = BitstampWatcher(triggervolume=self.config['volume_alert_threshold'])
+        # shared by every connection, see TwoBitBotFactory
+        self.bitstamp = bitstamp
+        self.responder = responder
         self.channels = list()
         self.broadcast_to_channels = list()
+        # users with a command still being responded to
+        self.busy_users = set()
         #self.broadcast_to_users = list()
-        self.responder = botresponder.BotResponder(self.config, self.bitstamp)
 
     # todo this overwrites ircclient var
     @property
@@ -77,6 +80,10 @@ class TwoBitBotIRC(irc.IRCClient):
         # not really necessary
         self.responder.set_name(self.nickname)
 
+    def connectionLost(self, reason):
+        irc.IRCClient.connectionLost(self, reason)
+        self.bitstamp.remove_alert_callback(self.broadcast_msg)
+
     def joined(self, channel):
         """Called when we finish joining a channel."""
         log.info("Joined %s." % (channel))
@@ -98,12 +105,19 @@ class TwoBitBotIRC(irc.IRCClient):
             respond_to = channel
             in_str = respond_to
 
-        if self.can_reply(userhost):
-            response = yield self.responder.dispatch(msg, user)
+        invocation = self.responder.parse(msg)
+        if invocation is not None and self.can_reply(userhost):
+            # slow commands like !wolfram are only rate limited once they respond, so until then
+            # ignore any more commands from the same user
+            self.busy_users.add(userhost)
+            try:
+                response = yield self.responder.run(invocation, user)
+            finally:
+                self.busy_users.discard(userhost)
             if response:
                 log.debug("RESPOND to %s@%s in %s with '%s'" % (user, userhost, in_str, response.encode("utf8")))
                 self.msg(respond_to, response.encode("utf8"))
-                self.responded_to_user(userhost)
+                self.responded_to_user(userhost, invocation[0].cost)
 
     def broadcast_msg(self, msg):
         """Send msg to all interested parties (per config)."""
@@ -122,15 +136,19 @@ class TwoBitBotIRC(irc.IRCClient):
             return True
         elif userhost in self.config['banned_users']:
             return False
+        elif userhost in self.busy_users:
+            return False
         elif self.factory.ratelimiter.is_limited(userhost):
             return False
         else:
             return True
 
-    def responded_to_user(self, userhost):
+    def responded_to_user(self, userhost, cost=1):
         """ Track when a user was replied to for ratelimiting.
-        Parameter: userhost"""
-        self.factory.ratelimiter.user_event_now(userhost)
+        Parameters:
+            userhost
+            cost - how many replies the response counts as"""
+        self.factory.ratelimiter.user_event_now(userhost, cost)
 
 
 class TwoBitBotFactory(ReconnectingClientFactory):
@@ -140,9 +158,17 @@ class TwoBitBotFactory(ReconnectingClientFactory):
         self.config = config
         self.ratelimiter = ratelimit.ExponentialRateLimiter(
             max_delay=self.config['max_command_usage_delay'], base_factor=2, reset_after=30*60)
+        # built once rather than per connection, so reconnecting doesn't start another tape recorder and feed,
+        # or another flair game with its own pollers and write-behind cache of the flair DB
+        rules, tiers = rules_from_config(self.config)
+        self.bitstamp = BitstampWatcher(triggervolume=self.config['volume_alert_threshold'],
+                                       wallvolume=self.config['wall_alert_threshold'],
+                                       tape_dir=self.config['tape_dir'], rules=rules, tiers=tiers,
+                                       adaptive=adaptive_from_config(self.config))
+        self.responder = botresponder.BotResponder(self.config, self.bitstamp)
 
     def buildProtocol(self, addr):
-        proto = TwoBitBotIRC(self.config)
+        proto = TwoBitBotIRC(self.config, self.bitstamp, self.responder)
         proto.factory = self
         return proto
 
@@ -171,6 +197,8 @@ def main():
     from twisted.internet import reactor
 
     factory = TwoBitBotFactory(config)
+    factory.responder.services.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', factory.responder.services.stopService)
 
     reactor.connectTCP(config['server'], config['server_port'], factory)
     reactor.run()
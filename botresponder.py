@@ -1,18 +1,72 @@
 #!/usr/bin/env python
 
-from twisted.internet import defer, threads
+from twisted.application import service
+from twisted.internet import defer
 
 import logging
+import sys
 import datetime
+import inspect
+from collections import namedtuple
 from decimal import Decimal
 
 from twobitbot import utils
-from twobitbot.flair import FlairGame
+from twobitbot.flair import FlairGame, FlairArchiveService, FlairUnavailableError, DEFAULT_INSTRUMENT
+from twobitbot.bitstampwatcher import BitstampTickerWatcher
+from twobitbot.utils.gazetteer import Gazetteer
+from twobitbot.utils.asynccache import AsyncCache
+from twobitbot.utils.workerpool import BoundedWorkerPool, PoolBusyError
+from twobitbot.utils import googleapis
 from exchangelib import forex, bitfinex
 
 log = logging.getLogger(__name__)
 
 
+Command = namedtuple('Command', ['name', 'handler', 'aliases', 'min_args', 'max_args', 'cost', 'deferred'])
+
+
+def command(name=None, aliases=(), min_args=None, max_args=None, cost=1, deferred=False):
+    """Declare a BotResponder method as a chat command.
+    Parameters:
+        name - command name, by default the method name without its cmd_ prefix
+        aliases - other names the command can be invoked by
+        min_args, max_args - accepted argument counts, by default taken from the method signature
+        cost - how many rate limit events responding to the command counts as
+        deferred - whether the command returns a Deferred, always true for generators (inlineCallbacks)
+    Apply it below any other decorators so the signature of the method itself is inspected."""
+    def decorate(f):
+        f.command = dict(name=name, aliases=aliases, min_args=min_args, max_args=max_args, cost=cost,
+                         deferred=deferred or inspect.isgeneratorfunction(f))
+        # commands are called as method(self, user, *args)
+        spec = inspect.getargspec(f)
+        positional = len(spec.args) - 2
+        if min_args is None:
+            f.command['min_args'] = max(positional - len(spec.defaults or ()), 0)
+        if max_args is None and not spec.varargs:
+            f.command['max_args'] = positional
+        return f
+    return decorate
+
+
+def build_command_table(cls):
+    """Map every name and alias of the commands declared on cls to its Command."""
+    table = dict()
+    for attr in dir(cls):
+        meta = getattr(getattr(cls, attr), 'command', None)
+        if meta is None:
+            continue
+        name = meta['name'] or (attr[len('cmd_'):] if attr.startswith('cmd_') else attr)
+        cmd = Command(name=name, handler=getattr(cls, attr).__func__, aliases=tuple(meta['aliases']),
+                      min_args=meta['min_args'], max_args=meta['max_args'], cost=meta['cost'],
+                      deferred=meta['deferred'])
+        for key in (name,) + cmd.aliases:
+            key = key.lower()
+            if key in table:
+                raise ValueError("Command name {} is used by both {} and {}".format(key, table[key].name, name))
+            table[key] = cmd
+    return table
+
+
 class BotResponder(object):
     def __init__(self, config, exchange_watcher):
         self.config = config
@@ -21,21 +75,46 @@ class BotResponder(object):
             self.name = self.config['botname']
         except KeyError:
             self.name = None
-        self.flair = FlairGame(self.exchange_watcher, db=self.config['flair_db'],
-                               change_delay=self.config['flair_change_delay'])
+        self._load_commands()
+        # background services, started and stopped by whoever owns the responder (see ircbot.tac and bot.main)
+        self.services = service.MultiService()
+        flair_watchers = {DEFAULT_INSTRUMENT: self.exchange_watcher}
+        for instrument in self.config['flair_instruments']:
+            instrument = instrument.lower()
+            if instrument not in flair_watchers:
+                flair_watchers[instrument] = BitstampTickerWatcher(instrument)
+                flair_watchers[instrument].start()
+        self.flair = FlairGame(flair_watchers, db=self.config['flair_db'],
+                               change_delay=self.config['flair_change_delay'],
+                               archive_db=self.config['flair_archive_db'] or None)
+        if self.config['flair_archive_db'] and self.config['flair_archive_days']:
+            self.flair_archiver = FlairArchiveService(self.flair, self.config['flair_archive_days'] * 24*60*60)
+            self.flair_archiver.setServiceParent(self.services)
 
         if self.config['wolfram_alpha_api_key']:
             import wolframalpha
             self.wolframalpha = wolframalpha.Client(self.config['wolfram_alpha_api_key'])
+            # Wolfram Alpha can be slow, so give it its own threads rather than tying up the reactor's
+            self.wolfram_pool = BoundedWorkerPool('wolfram', size=2, max_queued=4, timeout=20)
         else:
             self.wolframalpha = False
             """:type: wolframalpha.Client"""
 
+        self.gazetteer = Gazetteer(cache_path=self.config['location_cache'] or None)
+
         self.forex = forex.ForexConverterService(self.config['open_exchange_rates_app_id'])
         self.forex.startService()
 
-        self.bfx_swap_data = dict()
-        self.bfx_swap_data_time = None
+        # stale swap stats are fine for a while, but answers to queries like "price of gold" shouldn't get too old
+        self.swaps_cache = AsyncCache('swaps', ttl=5*60, max_size=1, max_stale=60*60)
+        self.math_cache = AsyncCache('math', ttl=10*60, max_size=500, negative_ttl=10*60, max_stale=10*60)
+
+    def _load_commands(self):
+        self.prefix = self.config['command_prefix']
+        self.commands = build_command_table(type(self))
+        # what parse() checks, kept out of the Command namedtuples since their field access is relatively slow
+        self._parse_table = dict((name, (cmd, cmd.min_args, sys.maxint if cmd.max_args is None else cmd.max_args))
+                                 for name, cmd in self.commands.iteritems())
 
     def set_name(self, nickname):
         self.name = nickname
@@ -45,38 +124,57 @@ class BotResponder(object):
         Parameters:
             msg - received message (string)
             user - who sent the message
-        Return value: response message (string/deferred)"""
-        # dispatching inspired by https://twistedmatrix.com/documents/current/core/examples/stdiodemo.py
-        msg = msg.strip()
+        Return value: response message (string/deferred)
+        Shorthand for parse() and run(), for callers that don't need the Command in between."""
+        invocation = self.parse(msg)
+        if invocation is not None:
+            return self.run(invocation, user)
 
-        # all commands are delegated to methods starting with cmd_
-        if msg.startswith(self.config['command_prefix']):
-            args = msg.split()
-            # remove the prefix
-            args[0] = args[0][len(self.config['command_prefix']):]
+    def parse(self, msg):
+        """ Find the command a received message invokes.
+        Return value: (Command, arguments) tuple, or None if msg is not a valid command."""
+        # most messages are just chat, so reject them before doing any other work
+        if not msg.startswith(self.prefix):
+            if not msg[:1].isspace():
+                return None
+            msg = msg.lstrip()
+            if not msg.startswith(self.prefix):
+                return None
 
-            cmd = args[0].lower()
-            args = args[1:]
-            try:
-                cmd_method = getattr(self, 'cmd_' + cmd)
-            except AttributeError as e:
-                log.debug('Invalid command {0} used by {1} with arguments {2}'.format(cmd, user, args))
-            else:
-                try:
-                    return cmd_method(user, *args)
-                except TypeError as e:
-                    log.warn('Issue dispatching {0} for {1} (cmd={2}, args={3}'.format(cmd_method, user, cmd, args),
-                             exc_info=True)
+        args = msg.split()
+        name = args[0][len(self.prefix):].lower()
+        args = args[1:]
+        entry = self._parse_table.get(name)
+        if entry is None:
+            log.debug('Invalid command %s with arguments %s', name, args)
+            return None
+        cmd, min_args, max_args = entry
+        if not min_args <= len(args) <= max_args:
+            log.debug('Wrong number of arguments for command %s: %s', cmd.name, args)
+            return None
+        return cmd, args
 
+    def run(self, invocation, user=''):
+        """ Respond to a command parsed from a message by parse().
+        Return value: response message (string), or a deferred if the command is deferred"""
+        cmd, args = invocation
+        return cmd.handler(self, user, *args)
+
+    @command()
     def cmd_donate(self, user=None):
         return "Bitcoin donations accepted at %s." % (self.config['btc_donation_addr'])
 
+    @command()
     def cmd_help(self, user=None):
         # todo update help stuff
-        return ("Commands: {0}time <location>, {0}flair <long|fiat|short>, {0}flair status [user], {0}flair top, "
-                "{0}forex <conversion>, {0}wolfram <query>, {0}swaps").format(self.config['command_prefix'])
+        return ("Commands: {0}time <location>, {0}flair <long|fiat|short> [instrument], {0}flair status [user], "
+                "{0}flair stats [user] [instrument], {0}flair top, {0}flair bottom, {0}flair sentiment [instrument], "
+                "{0}forex <conversion>, {0}wolfram <query>, {0}swaps, {0}price, {0}depth <amount> [buy|sell], "
+                "{0}alertstats, {0}cachestats").format(
+            self.config['command_prefix'])
 
     @defer.inlineCallbacks
+    @command(min_args=1)
     def cmd_time(self, user, *msg):
         # small usability change since users sometimes misuse this
         # command as "!time in X" instead of "!time X"
@@ -88,8 +186,12 @@ class BotResponder(object):
             defer.returnValue(None)
         log.info("Looking up current time in '%s' for %s" % (location, user))
 
-        localized = yield utils.lookup_localized_time(location, datetime.datetime.utcnow(),
-                                                      self.config['google_api_key'])
+        try:
+            localized = yield utils.lookup_localized_time(location, datetime.datetime.utcnow(),
+                                                          self.config['google_api_key'], self.gazetteer)
+        except googleapis.GoogleAPIError as e:
+            log.warn("Could not look up the time in '%s': %s" % (location, e))
+            defer.returnValue("Could not look up the time in %s right now, try again later." % (location))
         if localized:
             defer.returnValue("The time in %s is %s" %
                               (localized['location'],
@@ -98,6 +200,7 @@ class BotResponder(object):
             defer.returnValue("Invalid location.")
 
     @defer.inlineCallbacks
+    @command(aliases=('wolfram',), cost=2)
     def cmd_math(self, user, *msg):
         # todo:
         # - fucks up unicode (try "!math price of 1 bitcoin")
@@ -115,16 +218,23 @@ class BotResponder(object):
         else:
             user_query = ' '.join(msg)
             log.info("Querying Wolfram Alpha with '{}' for '{}'".format(user_query, user))
-            response = yield threads.deferToThread(self.wolframalpha.query, user_query)
-
-            answer = next(response.results, '')
-            answer = answer.text.strip() if answer else "I don't know what you mean."
+            try:
+                answer = yield self.math_cache.get(user_query.lower(), self._query_wolfram, user_query)
+            except PoolBusyError:
+                answer = "I'm busy with other queries, try again in a bit."
+            except defer.TimeoutError:
+                answer = "Wolfram Alpha is taking too long, try again later."
+            answer = answer or "I don't know what you mean."
             # todo replace this unicode literal with unicode_literal future import
             defer.returnValue(u"{}: {}".format(user, answer))
 
-    def cmd_wolfram(self, user, *msg):
-        return self.cmd_math(user, *msg)
+    @defer.inlineCallbacks
+    def _query_wolfram(self, query):
+        response = yield self.wolfram_pool.submit(self.wolframalpha.query, query)
+        answer = next(response.results, None)
+        defer.returnValue(answer.text.strip() if answer else None)
 
+    @command(aliases=('fx',), max_args=4)
     def cmd_forex(self, user, *msg):
         # todo consider accepting queries like !fx xau where the usd part of xauusd is just implicit
         if len(msg) == 1 and len(msg[0]) == 6:
@@ -169,10 +279,11 @@ class BotResponder(object):
             # todo display info on data source
             return "{} {} is {} {}".format(amount_str, from_currency.upper(), converted_str, to_currency.upper())
 
-    def cmd_fx(self, *msg):
-        return self.cmd_forex(*msg)
-
+    @command(deferred=True)
     def cmd_flair(self, user, *msg):
+        return self._flair(user, *msg).addErrback(self._flair_unavailable)
+
+    def _flair(self, user, *msg):
         if len(msg) == 0:
             log.info("No flair subcommand specified, so returning %s's flair stats." % (user))
             return self.flair.status(user)
@@ -190,24 +301,158 @@ class BotResponder(object):
         elif cmd == 'top':
             log.info("Returning top flair user statistics for %s" % (user))
             return self.flair.top(count=self.config['flair_top_list_size'])
+        elif cmd == 'bottom':
+            log.info("Returning bottom flair user statistics for %s" % (user))
+            return self.flair.bottom(count=self.config['flair_top_list_size'])
+        elif cmd == 'stats':
+            # stats [user] [instrument], or stats <instrument> for the user's own
+            args = list(msg[1:3])
+            target = args.pop(0) if args and args[0].lower() not in self.flair.instruments else user
+            log.info("Returning %s's flair history stats for %s" % (target, user))
+            return self.flair.stats(target, *args)
+        elif cmd == 'sentiment':
+            log.info("Returning flair sentiment for %s" % (user))
+            return self.flair.sentiment_summary(*msg[1:2])
         else:
 #        elif cmd == 'bull' or cmd == 'bear':
             log.info("Attempting to change %s's flair to %s" % (user, cmd))
-            return self.flair.change(user, cmd)
+            return self.flair.change(user, cmd, *msg[1:2])
+
+    @staticmethod
+    def _flair_unavailable(failure):
+        failure.trap(FlairUnavailableError)
+        return FlairGame.msg_unavailable
+
+    @command()
+    def cmd_depth(self, user, amount=None, side='buy'):
+        """Estimate the fill of a Bitstamp market order from the current order book."""
+        if amount is None:
+            return "Usage: {0}depth <amount> [buy|sell], e.g. {0}depth 500 sell".format(self.config['command_prefix'])
+        side = side.lower()
+        if side not in ('buy', 'sell'):
+            return
+        try:
+            amount = Decimal(amount)
+            if not 0 < amount < 1e9:
+                return
+        except ArithmeticError:
+            # InvalidOperation for input like 'abc' or 'nan'
+            return
+
+        # no snapshot if the book is stale, and the slippage is against its mid, the same quote the flairs use
+        snapshot = self.exchange_watcher.snapshot()
+        if snapshot is None or not snapshot.mid:
+            return FlairGame.msg_no_orderbook_data
+        fill = self.exchange_watcher.orderbook.market_order(amount, side == 'buy')
+        if not fill:
+            return FlairGame.msg_no_orderbook_data
+        filled, avg_price, worst_price = fill
+        mid = float(snapshot.mid)
+        slippage = (avg_price - mid) / mid
+
+        if filled < amount:
+            filled_str = " Only {} BTC is in the book, which".format(utils.truncatefloat(filled, commas=True))
+        else:
+            filled_str = ""
+        log.info("Estimated depth for a {} BTC market {} for {}".format(amount, side, user))
+        return ("Bitstamp market {} of {} BTC:{} fills at an average ${:,.2f} (worst ${:,.2f}), "
+                "{:+.2%} slippage vs mid ${:,.2f}.".format(side, utils.truncatefloat(amount, commas=True), filled_str,
+                                                          avg_price, worst_price, slippage, mid))
+
+    @command()
+    def cmd_price(self, user, *msg):
+        summary = self.exchange_watcher.price_summary()
+        if not summary:
+            return "I haven't seen any Bitstamp trades in the last 24 hours."
+        change = (summary['last'] - summary['open']) / summary['open']
+        return ("Bitstamp BTCUSD last ${last:,.2f} | 24h {change:+.2%}, high ${high:,.2f}, low ${low:,.2f}, "
+                "volume {volume_str} BTC, VWAP ${vwap:,.2f}".format(
+                    change=change, volume_str=utils.truncatefloat(summary['volume'], decimals=0, commas=True),
+                    **summary))
+
+    @command()
+    def cmd_alertstats(self, user, *msg):
+        return self.exchange_watcher.alert_stats()
+
+    @command()
+    def cmd_cachestats(self, user, *msg):
+        stats = [str(cache) for cache in googleapis.caches + (self.swaps_cache, self.math_cache)]
+        if self.wolframalpha:
+            stats.append(str(self.wolfram_pool))
+        stats.append(str(self.flair.write_stats))
+        stats.append(str(self.flair.stats_pool))
+        return ' | '.join(stats)
 
     @defer.inlineCallbacks
+    @command()
     def cmd_swaps(self, user, *msg):
-        if not self.bfx_swap_data_time or utils.now_in_utc_secs() - self.bfx_swap_data_time > 5*30:
-            self.bfx_swap_data = dict()
-            # 2 for loops here so all 3 requests get sent ASAP
-            for currency in ('usd', 'btc', 'ltc'):
-                self.bfx_swap_data[currency] = bitfinex.lends(currency)
-            for c, d in self.bfx_swap_data.iteritems():
-                self.bfx_swap_data[c] = yield d
-            self.bfx_swap_data_time = utils.now_in_utc_secs()
+        bfx_swap_data = yield self.swaps_cache.get('swaps', self._fetch_swaps)
         swap_data = {}
         swap_data_strs = list()
-        for currency in self.bfx_swap_data.iterkeys():
-            swap_data[currency] = Decimal(self.bfx_swap_data[currency][0]['amount_lent'])
+        for currency in bfx_swap_data.iterkeys():
+            swap_data[currency] = Decimal(bfx_swap_data[currency][0]['amount_lent'])
             swap_data_strs.append('{} {}'.format(currency.upper(), utils.truncatefloat(swap_data[currency], commas=True)))
         defer.returnValue("Bitfinex open swaps: {}".format(', '.join(reversed(swap_data_strs))))
+
+    @defer.inlineCallbacks
+    def _fetch_swaps(self):
+        # send all 3 requests before waiting on any of them
+        requests = dict((currency, bitfinex.lends(currency)) for currency in ('usd', 'btc', 'ltc'))
+        swap_data = dict()
+        for c, d in requests.iteritems():
+            swap_data[c] = yield d
+        defer.returnValue(swap_data)
+
+
+def main():
+    """Benchmark dispatching a chat-heavy channel against the old strip/split/getattr dispatch."""
+    import random
+    import timeit
+
+    logging.basicConfig(level=logging.INFO)
+
+    # dispatch only needs the config and command table, so skip starting the services in __init__
+    responder = BotResponder.__new__(BotResponder)
+    responder.config = {'command_prefix': '!', 'btc_donation_addr': '1TwoBitBot'}
+    responder._load_commands()
+
+    def getattr_dispatch(msg, user=''):
+        msg = msg.strip()
+        if msg.startswith(responder.config['command_prefix']):
+            args = msg.split()
+            args[0] = args[0][len(responder.config['command_prefix']):]
+            cmd = args[0].lower()
+            args = args[1:]
+            try:
+                cmd_method = getattr(responder, 'cmd_' + cmd)
+            except AttributeError:
+                pass
+            else:
+                try:
+                    return cmd_method(user, *args)
+                except TypeError:
+                    pass
+
+    random.seed(21)
+    words = ['btc', 'going', 'to', 'the', 'moon', 'lol', 'bitstamp', 'wall', 'at', '350', 'dump', 'it', 'gox']
+    chat = [' '.join(random.choice(words) for _ in xrange(random.randint(1, 30))) for _ in xrange(9700)]
+    commands = ['!donate', '!DONATE', '!help', '!donate now', '!nosuchcommand with args'] * 60
+    msgs = chat + commands
+    random.shuffle(msgs)
+
+    for msg in msgs:
+        assert responder.dispatch(msg, 'user') == getattr_dispatch(msg, 'user'), msg
+    assert responder.dispatch('  !fx', 'user') == responder.cmd_forex('user')
+    assert responder.parse('!Wolfram pi')[0] is responder.commands['math']
+
+    print("Registered commands: {}".format(', '.join(sorted(responder.commands))))
+    for title, lines in (("chat-heavy channel ({:.0%} commands)".format(len(commands) / float(len(msgs))), msgs),
+                         ("commands only", commands)):
+        print("Dispatching {} lines, {}:".format(len(lines), title))
+        for name, dispatch in (("getattr", getattr_dispatch), ("registry", responder.dispatch)):
+            best = min(timeit.repeat(lambda: [dispatch(msg, 'user') for msg in lines], number=10, repeat=5)) / 10
+            print("  {:<8} {:.3f}ms, {:.2f}us per line".format(name, best * 1e3, best * 1e6 / len(lines)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import logging
+from array import array
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+MINUTE = 60 * 1000
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+
+class CandleSeries(object):
+    """
+    OHLCV candles of one timeframe, kept in a fixed-size ring buffer with array-backed columns.
+
+    Candles are built from trades, or folded together from the closed candles of a lower timeframe,
+    so higher timeframes never have to look at individual trades.
+    """
+
+    def __init__(self, period, size):
+        """
+        :param period: candle length in ms
+        :param size: how many closed candles to keep, older ones are overwritten
+        """
+        self.period = period
+        self.size = size
+
+        self.start = array('l', [0]) * size
+        self.open = array('d', [0.0]) * size
+        self.high = array('d', [0.0]) * size
+        self.low = array('d', [0.0]) * size
+        self.close = array('d', [0.0]) * size
+        self.volume = array('d', [0.0]) * size
+        # sum of price*amount, for VWAP
+        self.notional = array('d', [0.0]) * size
+
+        # sequence numbers of the oldest closed candle kept, and of the next candle to be closed
+        self.head = 0
+        self.tail = 0
+        # the candle being built, as [start, open, high, low, close, volume, notional]
+        self.current = None
+
+        self.close_listeners = list()
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def add_trade(self, timestamp, price, amount):
+        self.update(timestamp, price, price, price, price, amount, price * amount)
+
+    def update(self, timestamp, open_, high, low, close, volume, notional):
+        """Merge a trade or a lower timeframe candle starting at timestamp (ms) into the series."""
+        start = timestamp - timestamp % self.period
+        current = self.current
+        if current is not None and current[0] != start:
+            self._close()
+            current = None
+        if current is None:
+            self.current = [start, open_, high, low, close, volume, notional]
+        else:
+            if high > current[2]:
+                current[2] = high
+            if low < current[3]:
+                current[3] = low
+            current[4] = close
+            current[5] += volume
+            current[6] += notional
+
+    def candle(self, seq):
+        """Return closed candle seq as a tuple of (start, open, high, low, close, volume, notional)."""
+        if not self.head <= seq < self.tail:
+            raise IndexError("Candle {} is not in the series".format(seq))
+        i = seq % self.size
+        return (self.start[i], self.open[i], self.high[i], self.low[i], self.close[i],
+                self.volume[i], self.notional[i])
+
+    def _close(self):
+        seq = self.tail
+        i = seq % self.size
+        (self.start[i], self.open[i], self.high[i], self.low[i], self.close[i],
+         self.volume[i], self.notional[i]) = self.current
+        self.tail += 1
+        if self.tail - self.head > self.size:
+            self.head += 1
+        for cb in self.close_listeners:
+            cb(self, seq)
+
+
+class RollingStats(object):
+    """
+    High, low, volume and VWAP over a rolling horizon, kept up to date from the closed candles of a series.
+
+    Volume and notional are running sums and the high/low are tracked with monotonic deques,
+    so both updating and querying are O(1) amortized.
+    """
+
+    def __init__(self, series, horizon):
+        """
+        :type series: CandleSeries
+        :param horizon: length of the rolling window in ms, the series must keep at least that many candles
+        """
+        if series.size * series.period < horizon:
+            raise ValueError("Series does not keep enough candles for a {}ms horizon".format(horizon))
+        self.series = series
+        self.horizon = horizon
+        # sequence number of the oldest closed candle in the window
+        self.first = 0
+        self.volume = 0.0
+        self.notional = 0.0
+        self._highs = deque()
+        self._lows = deque()
+        series.close_listeners.append(self._on_close)
+
+    def _on_close(self, series, seq):
+        i = seq % series.size
+        # expire as candles close too, so the window never spans more candles than the series keeps
+        self.expire(series.start[i] + series.period)
+        self.volume += series.volume[i]
+        self.notional += series.notional[i]
+        while self._highs and series.high[self._highs[-1] % series.size] <= series.high[i]:
+            self._highs.pop()
+        self._highs.append(seq)
+        while self._lows and series.low[self._lows[-1] % series.size] >= series.low[i]:
+            self._lows.pop()
+        self._lows.append(seq)
+
+    def expire(self, now):
+        """Drop closed candles that started more than horizon ms before now."""
+        series = self.series
+        cutoff = now - self.horizon
+        while self.first < series.tail and series.start[self.first % series.size] < cutoff:
+            seq = self.first
+            i = seq % series.size
+            self.volume -= series.volume[i]
+            self.notional -= series.notional[i]
+            if self._highs and self._highs[0] == seq:
+                self._highs.popleft()
+            if self._lows and self._lows[0] == seq:
+                self._lows.popleft()
+            self.first += 1
+        if self.first == series.tail:
+            # empty window, so drop any float error accumulated by the running sums
+            self.volume = self.notional = 0.0
+
+    def summary(self, now):
+        """
+        Summarize the horizon, including the candle still being built.
+
+        :return: dict with 'open', 'high', 'low', 'last', 'volume' and 'vwap' keys, or None if there were no trades
+        """
+        self.expire(now)
+        series = self.series
+        size = series.size
+        current = series.current
+        if current is not None and current[0] < now - self.horizon:
+            current = None
+
+        if self.first < series.tail:
+            first = self.first % size
+            open_ = series.open[first]
+            high = series.high[self._highs[0] % size]
+            low = series.low[self._lows[0] % size]
+            last = series.close[(series.tail - 1) % size]
+        elif current is not None:
+            open_, high, low = current[1], current[2], current[3]
+        else:
+            return None
+
+        volume, notional = self.volume, self.notional
+        if current is not None:
+            high = max(high, current[2])
+            low = min(low, current[3])
+            last = current[4]
+            volume += current[5]
+            notional += current[6]
+
+        return {'open': open_, 'high': high, 'low': low, 'last': last, 'volume': volume,
+                'vwap': notional / volume if volume else last}
+
+
+class CandleAggregator(object):
+    """Builds 1m, 5m, 1h and 24h candles from a trade stream, plus rolling 24h statistics."""
+
+    def __init__(self):
+        self.minutes = CandleSeries(MINUTE, 24 * 60 + 1)
+        self.five_minutes = CandleSeries(5 * MINUTE, 7 * 24 * 12)
+        self.hours = CandleSeries(HOUR, 30 * 24)
+        self.days = CandleSeries(DAY, 365)
+        self.series = (self.minutes, self.five_minutes, self.hours, self.days)
+
+        # roll closed candles up into the next timeframe
+        for lower, higher in zip(self.series, self.series[1:]):
+            lower.close_listeners.append(self._roll_up(higher))
+
+        self.rolling = RollingStats(self.minutes, DAY)
+
+    def add_trade(self, timestamp, price, amount):
+        """
+        :param timestamp: trade time in ms
+        """
+        self.minutes.add_trade(timestamp, float(price), float(amount))
+
+    def summary(self, now):
+        """Rolling 24h summary as of now (ms). See RollingStats.summary."""
+        return self.rolling.summary(now)
+
+    @staticmethod
+    def _roll_up(higher):
+        def roll_up(lower, seq):
+            higher.update(*lower.candle(seq))
+        return roll_up
+
+
+def main():
+    """Check the rolling 24h summary against a brute force computation, and time trade ingestion."""
+    import random
+    import time
+
+    random.seed(0)
+    trades = list()
+    ts, price = 0, 350.0
+    for _ in xrange(200000):
+        ts += random.randint(0, 2000)
+        price = max(1.0, price + random.gauss(0, 0.1))
+        trades.append((ts, price, random.expovariate(1)))
+
+    candles = CandleAggregator()
+    start = time.time()
+    for ts, price, amount in trades:
+        candles.add_trade(ts, price, amount)
+    secs = time.time() - start
+    print("{} trades in {:.2f}s ({:.0f} trades/s)".format(len(trades), secs, len(trades) / secs))
+
+    now = trades[-1][0]
+    # the rolling window covers whole minute candles, so compare against trades from the first covered minute
+    cutoff = now - DAY
+    cutoff += -cutoff % MINUTE
+    window = [t for t in trades if t[0] >= cutoff]
+    summary = candles.summary(now)
+    print("rolling: {}".format(summary))
+    print("exact:   open {} high {} low {} last {} volume {} vwap {}".format(
+        window[0][1], max(t[1] for t in window), min(t[1] for t in window), window[-1][1],
+        sum(t[2] for t in window), sum(t[1] * t[2] for t in window) / sum(t[2] for t in window)))
+    print("{} 1m, {} 5m, {} 1h, {} 24h candles closed".format(*[len(s) for s in candles.series]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import logging
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+from sortedcontainers import SortedDict
+
+from twobitbot import utils
+
+log = logging.getLogger(__name__)
+
+# Bitstamp quotes prices in cents
+PRICE_DECIMALS = 2
+
+
+def price_key(price):
+    """Price rounded to the book's tick, for matching prices that were parsed or computed separately, e.g. a trade's
+    price against a level's, which float equality can't be relied on for."""
+    return round(price, PRICE_DECIMALS)
+
+
+class PriceSnapshot(namedtuple('PriceSnapshot', ['bid', 'ask', 'mid', 'timestamp', 'sequence'])):
+    """
+    Top of book as of one update: bid, ask and mid price, when it was taken (seconds) and the book's
+    sequence number. It's immutable and replaced as a whole on every update, so a bid and ask read
+    from one snapshot always come from the same book.
+    """
+    __slots__ = ()
+
+    def age(self, now):
+        return now - self.timestamp
+
+
+class OrderBook(object):
+    """
+    Incrementally maintained order book.
+
+    Each side is a SortedDict of price -> amount, so inserting, updating or deleting a price level is O(log n).
+    The best bid and ask are cached after every update, and full snapshots are applied by only touching
+    the levels that differ from the current book.
+    """
+
+    def __init__(self):
+        # both sides sorted by ascending price, so the best bid is the last bid and the best ask the first ask
+        self.bids = SortedDict()
+        self.asks = SortedDict()
+
+        self.best_bid = None
+        self.best_ask = None
+
+        # incremented on every update that changed the book
+        self.sequence = 0
+
+        self.listeners = list()
+        # (is_bid, price, old_amount, new_amount) for each level changed by the update being applied
+        self._changes = list()
+
+        # is_bid -> (sequence, prices, cumulative sizes, cumulative notionals), built lazily by market_order
+        self._depth = dict()
+
+    def __len__(self):
+        return len(self.bids) + len(self.asks)
+
+    def apply_snapshot(self, bids, asks):
+        """
+        Resync the book from a full snapshot.
+
+        :param bids: bid levels as dicts with 'price' and 'amount' keys
+        :type bids: list
+        :param asks: ask levels as dicts with 'price' and 'amount' keys
+        :type asks: list
+        :return: True if the book changed
+        """
+        changed = self._resync_side(self.bids, bids)
+        changed = self._resync_side(self.asks, asks) or changed
+        return self._updated(changed)
+
+    def apply_diff(self, bids, asks):
+        """
+        Apply an incremental update. A level with an amount of 0 is removed from the book.
+
+        :return: True if the book changed
+        """
+        changed = False
+        for level in bids:
+            changed = self.set_level(True, level['price'], level['amount']) or changed
+        for level in asks:
+            changed = self.set_level(False, level['price'], level['amount']) or changed
+        return self._updated(changed)
+
+    def add_listener(self, callback):
+        """
+        Register a callback that is called after every update that changed the book.
+        It is passed a list of (is_bid, price, old_amount, new_amount) tuples, one for each changed level.
+        """
+        if callable(callback):
+            self.listeners.append(callback)
+        else:
+            raise ValueError("Order book listener must be callable.")
+
+    def set_level(self, is_bid, price, amount):
+        """
+        Set the amount resting at a price level, removing the level if amount is 0.
+        Does not refresh the best bid/ask, use apply_diff unless you are batching updates.
+
+        :return: True if the book changed
+        """
+        side = self.bids if is_bid else self.asks
+        old = side.get(price, 0)
+        if old == amount:
+            return False
+        if amount:
+            side[price] = amount
+        else:
+            del side[price]
+        if self.listeners:
+            self._changes.append((is_bid, price, old, amount))
+        return True
+
+    @property
+    def mid(self):
+        if self.best_bid is None or self.best_ask is None:
+            return None
+        return (self.best_bid + self.best_ask) / 2
+
+    def price_snapshot(self, timestamp):
+        """The current top of book as a PriceSnapshot taken at timestamp, or None if either side is empty."""
+        if self.best_bid is None or self.best_ask is None:
+            return None
+        return PriceSnapshot(self.best_bid, self.best_ask, (self.best_bid + self.best_ask) / 2, timestamp,
+                             self.sequence)
+
+    def market_order(self, amount, is_buy):
+        """
+        Work out what a market order would fill at if it were executed against the book right now.
+
+        A buy walks the asks and a sell the bids. The side's cumulative size and notional arrays are rebuilt
+        only if the book changed since they were last built, then the fill is found with a binary search.
+
+        :param amount: BTC amount of the market order
+        :param is_buy: True for a market buy, False for a market sell
+        :return: tuple of filled amount, average fill price and worst fill price,
+            or None if that side of the book is empty. Filled amount is less than amount if the book is too thin.
+        """
+        prices, cum_size, cum_notional = self._depth_arrays(not is_buy)
+        if not prices:
+            return None
+
+        amount = float(amount)
+        i = bisect_left(cum_size, amount)
+        if i == len(cum_size):
+            # not enough liquidity in the book, so the order eats the whole side
+            return cum_size[-1], cum_notional[-1] / cum_size[-1], prices[-1]
+
+        size_before = cum_size[i - 1] if i else 0.0
+        notional_before = cum_notional[i - 1] if i else 0.0
+        notional = notional_before + (amount - size_before) * prices[i]
+        return amount, notional / amount, prices[i]
+
+    def _depth_arrays(self, is_bid):
+        cached = self._depth.get(is_bid)
+        if cached and cached[0] == self.sequence:
+            return cached[1:]
+
+        prices = array('d')
+        cum_size = array('d')
+        cum_notional = array('d')
+        size = notional = 0.0
+        for price, amount in (self.iter_bids() if is_bid else self.iter_asks()):
+            price = float(price)
+            size += float(amount)
+            notional += float(amount) * price
+            prices.append(price)
+            cum_size.append(size)
+            cum_notional.append(notional)
+
+        self._depth[is_bid] = (self.sequence, prices, cum_size, cum_notional)
+        return prices, cum_size, cum_notional
+
+    def iter_bids(self):
+        """Iterate over (price, amount) bid levels from best to worst without copying the book."""
+        bids = self.bids
+        for price in reversed(bids):
+            yield price, bids[price]
+
+    def iter_asks(self):
+        """Iterate over (price, amount) ask levels from best to worst without copying the book."""
+        asks = self.asks
+        for price in asks:
+            yield price, asks[price]
+
+    def clear(self):
+        """Empty the book. Listeners are told about every removed level, like for any other update."""
+        if self.listeners:
+            self._changes.extend((True, price, amount, 0) for price, amount in self.iter_bids())
+            self._changes.extend((False, price, amount, 0) for price, amount in self.iter_asks())
+        self.bids.clear()
+        self.asks.clear()
+        self._updated(True)
+
+    def _resync_side(self, side, levels):
+        is_bid = side is self.bids
+        new = dict((level['price'], level['amount']) for level in levels if level['amount'])
+        changed = False
+        for price in [p for p in side if p not in new]:
+            changed = self.set_level(is_bid, price, 0) or changed
+        for price, amount in new.iteritems():
+            changed = self.set_level(is_bid, price, amount) or changed
+        return changed
+
+    def _updated(self, changed):
+        if changed:
+            self.sequence += 1
+            self.best_bid = self.bids.peekitem(-1)[0] if self.bids else None
+            self.best_ask = self.asks.peekitem(0)[0] if self.asks else None
+            if self._changes:
+                changes, self._changes = self._changes, list()
+                for cb in self.listeners:
+                    cb(changes)
+        return changed
+
+
+class WallTracker(object):
+    """
+    Track walls (unusually large resting orders) in an OrderBook and alert when they appear, get pulled or get eaten.
+
+    Only the levels changed by each book update are looked at, so the cost of an update does not depend
+    on how deep the book is. Snapshots only cover the top of the book, so walls that come into range as the price
+    moves, including all of them in the first snapshot, are tracked without an alert.
+    """
+
+    def __init__(self, book, min_amount, alert_callback):
+        """
+        :param book: order book to watch
+        :type book: OrderBook
+        :param min_amount: a level with at least this much BTC resting is a wall
+        :param alert_callback: called with an alert message (unicode)
+        """
+        self.book = book
+        self.min_amount = min_amount
+        self.alert_callback = alert_callback
+
+        # (is_bid, price) -> amount of every wall currently in the book
+        self.walls = dict()
+        # price_key -> volume traded there since the last book update, used to tell eaten walls from pulled ones
+        self._traded = dict()
+        # deepest bid and ask as of the previous update, None while a side is empty
+        self._bounds = (None, None)
+
+        book.add_listener(self.on_book_changes)
+
+    def on_trade(self, price, amount):
+        key = price_key(price)
+        self._traded[key] = self._traded.get(key, 0) + amount
+
+    def on_book_changes(self, changes):
+        walls = self.walls
+        previous_bounds = self._bounds
+        for is_bid, price, old, new in changes:
+            key = (is_bid, price)
+            if new >= self.min_amount:
+                if key not in walls and self._in_range(is_bid, price, previous_bounds):
+                    self._alert(u"wall appeared", is_bid, price, new)
+                walls[key] = new
+            elif key in walls:
+                del walls[key]
+                if self._traded.get(price_key(price), 0) * 2 >= old - new:
+                    self._alert(u"wall eaten", is_bid, price, old)
+                elif new or self._in_book_range(is_bid, price):
+                    self._alert(u"wall pulled", is_bid, price, old)
+                # otherwise the level just moved out of the snapshot's depth
+        self._traded.clear()
+        self._bounds = self._book_bounds()
+
+    def _book_bounds(self):
+        bids, asks = self.book.bids, self.book.asks
+        return bids.peekitem(0)[0] if bids else None, asks.peekitem(-1)[0] if asks else None
+
+    @staticmethod
+    def _in_range(is_bid, price, bounds):
+        """Whether price is inside the range of levels covered on that side, per (deepest bid, deepest ask)."""
+        bid_floor, ask_ceiling = bounds
+        if is_bid:
+            return bid_floor is not None and price >= bid_floor
+        else:
+            return ask_ceiling is not None and price <= ask_ceiling
+
+    def _in_book_range(self, is_bid, price):
+        """Whether price is inside the range of levels the book currently covers on that side."""
+        return self._in_range(is_bid, price, self._book_bounds())
+
+    def _alert(self, event, is_bid, price, amount):
+        msg = u"Bitstamp alert | {} | {} BTC {} at ${:.2f}".format(
+            event, utils.truncatefloat(amount), u"bid" if is_bid else u"ask", price)
+        log.info(msg.encode('utf8'))
+        self.alert_callback(msg)
+
+
+def main():
+    """Benchmark OrderBook + WallTracker on a synthetic feed, to check they keep up with Bitstamp on one thread."""
+    import random
+    import time
+
+    # walls in the first snapshot and ones coming into range are tracked silently, the rest are alerted on
+    book = OrderBook()
+    alerts = list()
+    tracker = WallTracker(book, min_amount=400, alert_callback=alerts.append)
+    book.apply_snapshot([{'price': 299.95, 'amount': 500}, {'price': 299.9, 'amount': 1}],
+                        [{'price': 300.05, 'amount': 1}, {'price': 300.3, 'amount': 1}])
+    assert not alerts and len(tracker.walls) == 1
+    book.apply_diff([{'price': 299.85, 'amount': 500}], [{'price': 300.3, 'amount': 500}])
+    assert len(alerts) == 1 and u"appeared" in alerts[0] and u"ask" in alerts[0], alerts
+    # a wall eaten by a trade whose price was computed rather than parsed
+    tracker.on_trade(100.1 * 3, 500)
+    book.apply_diff([], [{'price': 300.3, 'amount': 0}])
+    assert u"eaten" in alerts[-1], alerts
+    # clearing the book drops its walls without alerting, and the next snapshot seeds them again
+    book.clear()
+    assert not tracker.walls and len(alerts) == 2
+    book.apply_snapshot([{'price': 299.95, 'amount': 500}], [{'price': 300.05, 'amount': 500}])
+    assert len(tracker.walls) == 2 and len(alerts) == 2
+
+    levels = 500
+    updates = 20000
+    random.seed(0)
+
+    book = OrderBook()
+    alerts = list()
+    WallTracker(book, min_amount=400, alert_callback=alerts.append)
+
+    def random_amount():
+        return 500 if random.random() < 0.01 else round(random.uniform(0.01, 50), 2)
+
+    book.apply_snapshot([{'price': 300 - i * 0.05, 'amount': random_amount()} for i in xrange(levels)],
+                        [{'price': 300.05 + i * 0.05, 'amount': random_amount()} for i in xrange(levels)])
+
+    feed = list()
+    for _ in xrange(updates):
+        bids = [{'price': round(300 - random.randint(0, levels) * 0.05, 2),
+                 'amount': random.choice((0, random_amount()))} for _ in xrange(3)]
+        asks = [{'price': round(300.05 + random.randint(0, levels) * 0.05, 2),
+                 'amount': random.choice((0, random_amount()))} for _ in xrange(3)]
+        feed.append((bids, asks))
+
+    start = time.time()
+    for bids, asks in feed:
+        book.apply_diff(bids, asks)
+    secs = time.time() - start
+    print("{} diffs of 6 levels against a {} level book: {:.0f} updates/s, {} wall alerts".format(
+        updates, 2 * levels, updates / secs, len(alerts)))
+
+    snapshots = 200
+    start = time.time()
+    for _ in xrange(snapshots):
+        book.apply_snapshot([{'price': p, 'amount': a if random.random() > 0.05 else random_amount()}
+                             for p, a in book.iter_bids()],
+                            [{'price': p, 'amount': a if random.random() > 0.05 else random_amount()}
+                             for p, a in book.iter_asks()])
+    secs = time.time() - start
+    print("{} full snapshot resyncs of {} levels: {:.0f} snapshots/s".format(snapshots, len(book), snapshots / secs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import logging
+import random
+import time
+from collections import defaultdict
+
+from twisted.internet import task
+
+from twobitbot.bitstampwatcher import BitstampWatcher
+from twobitbot.alertrules import rules_from_config, adaptive_from_config
+from twobitbot.tape import Kind, TapeReader
+
+log = logging.getLogger(__name__)
+
+
+class ReplayAPI(object):
+    """Local stand-in for exchangelib's BitstampWebsocketAPI2 that lets ticks be pushed to listeners directly."""
+
+    def __init__(self):
+        self.listeners = defaultdict(list)
+
+    def listen(self, event, callback):
+        self.listeners[event].append(callback)
+
+    def emit(self, event, data):
+        for cb in self.listeners[event]:
+            cb(data)
+
+
+def tape_ticks(paths):
+    """
+    Turn tape segments into replayable ticks.
+
+    :param paths: tape segment files, in chronological order
+    :return: iterator of (timestamp_ms, event, data) tuples
+    """
+    for path in paths:
+        with TapeReader(path) as tape:
+            for kind, _, ts, a, b, c, d in tape:
+                if kind == Kind.TRADE:
+                    yield ts, 'trade', {'price': a, 'amount': b}
+                elif kind == Kind.QUOTE:
+                    yield ts, 'orderbook', {'bids': [{'price': a, 'amount': c}], 'asks': [{'price': b, 'amount': d}]}
+
+
+def synthetic_ticks(count, start_ms=0, seed=0, price=350.0):
+    """
+    Generate a random walk of quotes and trades, with occasional one-sided bursts of market orders.
+
+    :return: iterator of (timestamp_ms, event, data) tuples
+    """
+    rng = random.Random(seed)
+    ts = start_ms
+    burst = 0
+    for i in xrange(count):
+        ts += rng.randint(0, 2000)
+        if i % 10 == 0:
+            price = max(1.0, price + rng.gauss(0, 0.2))
+            yield ts, 'orderbook', {'bids': [{'price': round(price - 0.05, 2), 'amount': rng.uniform(1, 20)}],
+                                    'asks': [{'price': round(price + 0.05, 2), 'amount': rng.uniform(1, 20)}]}
+            continue
+
+        if not burst and rng.random() < 0.002:
+            burst = rng.randint(20, 60)
+            burst_buy = rng.random() < 0.5
+        if burst:
+            burst -= 1
+            is_buy = burst_buy
+            amount = rng.uniform(2, 15)
+        else:
+            is_buy = rng.random() < 0.5
+            amount = rng.expovariate(1)
+        trade_price = round(price + 0.05, 2) if is_buy else round(price - 0.05, 2)
+        yield ts, 'trade', {'price': trade_price, 'amount': amount}
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+class Replay(object):
+    """Drive a BitstampWatcher from recorded or synthetic ticks on a simulated clock."""
+
+    def __init__(self, triggervolume=100, wallvolume=0, rules=None, tiers=None, adaptive=None):
+        """Parameters are passed on to the BitstampWatcher, see there."""
+        self.api = ReplayAPI()
+        self.clock = task.Clock()
+        self.watcher = BitstampWatcher(triggervolume=triggervolume, wallvolume=wallvolume, api=self.api,
+                                       clock=self.clock, rules=rules, tiers=tiers, adaptive=adaptive)
+        self.alerts = list()
+        self.watcher.add_alert_callback(lambda msg: self.alerts.append((self.clock.seconds(), msg)))
+
+        self.ticks = 0
+        self.elapsed = 0
+        # event -> callback latencies in seconds
+        self.latencies = defaultdict(list)
+
+    def run(self, ticks):
+        """
+        Replay ticks as fast as possible, advancing the simulated clock to each tick's timestamp.
+
+        :param ticks: iterable of (timestamp_ms, event, data) tuples, e.g. from tape_ticks or synthetic_ticks
+        """
+        clock = self.clock
+        emit = self.api.emit
+        timer = time.time
+        start = timer()
+        for ts, event, data in ticks:
+            now = ts / 1000
+            if now > clock.seconds():
+                clock.advance(now - clock.seconds())
+            before = timer()
+            emit(event, data)
+            self.latencies[event].append(timer() - before)
+            self.ticks += 1
+        self.elapsed += timer() - start
+
+    def report(self):
+        lines = ["Replayed {} ticks in {:.2f}s ({:.0f} ticks/s), {} alerts".format(
+            self.ticks, self.elapsed, self.ticks / self.elapsed if self.elapsed else 0, len(self.alerts))]
+        for event, latencies in sorted(self.latencies.iteritems()):
+            latencies = sorted(latencies)
+            lines.append("  {:<10} n={:<8} p50 {:.1f}us  p90 {:.1f}us  p99 {:.1f}us  max {:.1f}us".format(
+                event, len(latencies), *[percentile(latencies, pct) * 1e6 for pct in (50, 90, 99, 100)]))
+        for secs, msg in self.alerts:
+            lines.append(u"  {} {}".format(time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(secs)), msg))
+        return u'\n'.join(lines)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Replay tape files or synthetic ticks through BitstampWatcher.")
+    parser.add_argument('tapes', nargs='*', help="tape segment files to replay, in order")
+    parser.add_argument('--synthetic', type=int, default=0, metavar='N', help="replay N synthetic ticks instead")
+    parser.add_argument('--config', action='store_true',
+                        help="alert like the bot: thresholds, alert rules, tiers and adaptive thresholds from its "
+                             "config file, with --threshold and --walls overriding the thresholds")
+    parser.add_argument('--threshold', type=int,
+                        help="volume alert threshold in BTC, 100 by default. With --config, it replaces the "
+                             "threshold of every alert rule")
+    parser.add_argument('--walls', type=int, help="wall alert threshold in BTC, 0 (off) by default")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        ticks = synthetic_ticks(args.synthetic)
+    elif args.tapes:
+        ticks = tape_ticks(args.tapes)
+    else:
+        parser.error("nothing to replay")
+
+    if args.config:
+        from twobitbot.utils import configure
+        config = configure.load_config()
+        rules, tiers = rules_from_config(config)
+        if args.threshold is not None:
+            config['volume_alert_threshold'] = args.threshold
+            # [alert_rules] entries have thresholds of their own
+            for rule in rules:
+                rule.threshold = args.threshold
+        replay = Replay(triggervolume=config['volume_alert_threshold'],
+                        wallvolume=config['wall_alert_threshold'] if args.walls is None else args.walls,
+                        rules=rules, tiers=tiers, adaptive=adaptive_from_config(config))
+    else:
+        replay = Replay(triggervolume=100 if args.threshold is None else args.threshold, wallvolume=args.walls or 0)
+    replay.run(ticks)
+    print(replay.report().encode('utf8'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+import logging
+import mmap
+import os
+import struct
+import time
+
+from twisted.internet import defer, task, threads
+
+log = logging.getLogger(__name__)
+
+
+class Kind(object):
+    TRADE = 1
+    QUOTE = 2
+
+
+class Side(object):
+    UNKNOWN = 0
+    BUY = 1
+    SELL = 2
+
+    @staticmethod
+    def from_is_buy(is_buy):
+        if is_buy is None:
+            return Side.UNKNOWN
+        return Side.BUY if is_buy else Side.SELL
+
+
+# Every record is the same width: kind, side, UTC timestamp in ms, then four doubles.
+# Trades use them for price and amount (the last two are 0), quotes for bid, ask, bid amount and ask amount.
+RECORD = struct.Struct('<BB6xqdddd')
+MAGIC = b'TBBTAPE1'
+MS_PER_DAY = 24 * 60 * 60 * 1000
+
+
+def segment_path(directory, timestamp_ms, prefix='bitstamp'):
+    """Path of the daily segment file a record with this timestamp belongs in."""
+    day = time.strftime('%Y%m%d', time.gmtime(timestamp_ms // 1000))
+    return os.path.join(directory, '{}-{}.tape'.format(prefix, day))
+
+
+class TapeRecorder(object):
+    """
+    Append-only recorder of trades and top of book changes to daily segment files of fixed-width binary records.
+
+    Recording a tick only packs it into an in-memory buffer. The buffer is written out every flush_interval
+    seconds in a thread, so disk IO never happens on the reactor thread.
+    """
+
+    def __init__(self, directory, flush_interval=5, prefix='bitstamp'):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.prefix = prefix
+
+        self._buffer = bytearray()
+        self._day = None
+        self._path = None
+        # writes are chained so segments are always appended to in order
+        self._writing = defer.succeed(None)
+        self._flusher = None
+
+        self.records = 0
+
+    def start(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._flusher = task.LoopingCall(self.flush)
+        self._flusher.start(self.flush_interval, now=False)
+        log.info("Recording tape to {}".format(self.directory))
+
+    def stop(self):
+        """Stop the periodic flush and write out anything left in the buffer."""
+        if self._flusher and self._flusher.running:
+            self._flusher.stop()
+        return self.flush()
+
+    def record_trade(self, timestamp_ms, price, amount, is_buy=None):
+        self._append(timestamp_ms, RECORD.pack(Kind.TRADE, Side.from_is_buy(is_buy), timestamp_ms,
+                                               price, amount, 0.0, 0.0))
+
+    def record_quote(self, timestamp_ms, bid, ask, bid_amount, ask_amount):
+        self._append(timestamp_ms, RECORD.pack(Kind.QUOTE, Side.UNKNOWN, timestamp_ms,
+                                               bid, ask, bid_amount, ask_amount))
+
+    def flush(self):
+        """
+        Write the buffered records to their segment in a thread.
+
+        :rtype: defer.Deferred
+        """
+        if self._buffer:
+            data, path = bytes(self._buffer), self._path
+            self._buffer = bytearray()
+            self._writing.addCallback(lambda _: threads.deferToThread(self._write, path, data))
+            self._writing.addErrback(lambda failure: log.error("Failed writing tape to {}: {}".format(path, failure)))
+        return self._writing
+
+    def _append(self, timestamp_ms, record):
+        day = timestamp_ms // MS_PER_DAY
+        if day != self._day:
+            # the buffer only ever holds records for one segment
+            self.flush()
+            self._day = day
+            self._path = segment_path(self.directory, timestamp_ms, self.prefix)
+        self._buffer += record
+        self.records += 1
+
+    @staticmethod
+    def _write(path, data):
+        with open(path, 'ab') as f:
+            if f.tell() == 0:
+                f.write(MAGIC)
+            f.write(data)
+
+
+class TapeReader(object):
+    """
+    Memory-mapped reader for a tape segment.
+
+    Records are unpacked one at a time as they are iterated, so scanning a day of ticks
+    doesn't load the whole file into Python objects. A partially written trailing record is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size > len(MAGIC):
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._map[:len(MAGIC)] != MAGIC:
+                self.close()
+                raise IOError("{} is not a tape file".format(path))
+            self._count = (size - len(MAGIC)) // RECORD.size
+        else:
+            self._map = None
+            self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        """Return record i as a tuple of (kind, side, timestamp_ms, a, b, c, d)."""
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("Tape record {} out of range".format(i))
+        return RECORD.unpack_from(self._map, len(MAGIC) + i * RECORD.size)
+
+    def __iter__(self):
+        unpack_from = RECORD.unpack_from
+        data = self._map
+        for offset in xrange(len(MAGIC), len(MAGIC) + self._count * RECORD.size, RECORD.size):
+            yield unpack_from(data, offset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def trades(self):
+        """Iterate over (timestamp_ms, price, amount, side) of the trades in the segment."""
+        for kind, side, ts, price, amount, _, _ in self:
+            if kind == Kind.TRADE:
+                yield ts, price, amount, side
+
+    def quotes(self):
+        """Iterate over (timestamp_ms, bid, ask, bid_amount, ask_amount) of the top of book changes in the segment."""
+        for kind, _, ts, bid, ask, bid_amount, ask_amount in self:
+            if kind == Kind.QUOTE:
+                yield ts, bid, ask, bid_amount, ask_amount
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+
+def main():
+    """Print a summary of the tape segments given on the command line."""
+    import sys
+
+    for path in sys.argv[1:]:
+        with TapeReader(path) as tape:
+            trades = volume = quotes = 0
+            for kind, _, _, _, amount, _, _ in tape:
+                if kind == Kind.TRADE:
+                    trades += 1
+                    volume += amount
+                else:
+                    quotes += 1
+            print("{}: {} trades ({:.2f} BTC), {} quotes".format(path, trades, volume, quotes))
+
+
+if __name__ == '__main__':
+    main()
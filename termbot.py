@@ -37,10 +37,23 @@ class TerminalBot(basic.LineReceiver):
         print("Welcome! This should work if you aren't using Windows.")
 
     def lineReceived(self, line):
-        response = self.responder.dispatch(line)
+        invocation = self.responder.parse(line)
+        if invocation is None:
+            return
+        response = self.responder.run(invocation)
+        if invocation[0].deferred:
+            response.addCallback(self._respond).addErrback(self._failed)
+        else:
+            self._respond(response)
+
+    def _respond(self, response):
         if response:
             self.out(response)
 
+    def _failed(self, failure):
+        log.error("Command failed: {}".format(failure.getErrorMessage()))
+        self.out("Error: {}".format(failure.getTraceback()))
+
     def out(self, line):
         self.sendLine(line)
 
@@ -55,6 +68,8 @@ def main():
         sys.exit(1)
 
     bot = TerminalBot(config)
+    bot.responder.services.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', bot.responder.services.stopService)
     stdio.StandardIO(bot)
 
     reactor.run()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+import logging
+from collections import OrderedDict
+
+from twisted.internet import defer
+
+from twobitbot.utils.singleflight import SingleFlight
+
+log = logging.getLogger(__name__)
+
+
+class AsyncCache(object):
+    def __init__(self, name='', ttl=60, max_size=1000, negative_ttl=0, max_stale=None, is_negative=None, clock=None):
+        """
+        Caches the results of Deferred-returning functions, e.g. @defer.inlineCallbacks API calls.
+        Results are fresh for ttl seconds. After that they are stale for up to max_stale seconds more (forever if
+        None): a stale result is returned immediately while it is refreshed in the background.
+        Negative results, per is_negative (by default None), are cached for negative_ttl seconds and never served
+        stale. A negative result doesn't replace a stale positive one, in case it is a temporary upstream problem.
+        Failures are never cached. At most max_size results are kept, the least recently used are evicted first.
+        Concurrent loads of the same key share one upstream call.
+        """
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.max_stale = max_stale
+        self.is_negative = is_negative or (lambda value: value is None)
+        self.clock = clock
+
+        # key: (value, expiry time, negative), least recently used first
+        self.entries = OrderedDict()
+        self.flights = SingleFlight(name)
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refresh_errors = 0
+
+    def get(self, key, f, *args, **kwargs):
+        """Return a Deferred firing with the cached result for key, calling f(*args, **kwargs) to load it if
+        there is none or it is stale."""
+        now = self.clock.seconds()
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            value, expires, negative = entry
+            if now < expires:
+                self.entries[key] = entry
+                if negative:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                return defer.succeed(value)
+            elif not negative and (self.max_stale is None or now < expires + self.max_stale):
+                self.entries[key] = entry
+                self.stale_hits += 1
+                if not self.flights.in_flight(key):
+                    self._load(key, f, args, kwargs).addErrback(self._refresh_failed, key)
+                return defer.succeed(value)
+        self.misses += 1
+        return self._load(key, f, args, kwargs)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def _load(self, key, f, args, kwargs):
+        return self.flights.call(key, self._call, key, f, args, kwargs)
+
+    def _call(self, key, f, args, kwargs):
+        return defer.maybeDeferred(f, *args, **kwargs).addCallback(self._store, key)
+
+    def _store(self, value, key):
+        negative = self.is_negative(value)
+        previous = self.entries.get(key)
+        if negative and previous is not None and not previous[2]:
+            log.info("Keeping the stale {} result for {!r} over a negative one".format(self.name, key))
+            return value
+        ttl = self.negative_ttl if negative else self.ttl
+        if ttl:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, self.clock.seconds() + ttl, negative)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def _refresh_failed(self, failure, key):
+        self.refresh_errors += 1
+        log.warn("Could not refresh the {} result for {!r}, serving it stale: {}".format(
+            self.name, key, failure.getErrorMessage()))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        # misses that shared another miss's upstream call are coalesced
+        return "{} {} hits, {} stale, {} negative, {} misses ({} coalesced), {} cached".format(
+            self.name, self.hits, self.stale_hits, self.negative_hits, self.misses, self.flights.saved, len(self))
+
+
+def main():
+    from twisted.internet import task
+
+    logging.basicConfig(level=logging.INFO)
+    clock = task.Clock()
+    cache = AsyncCache('test', ttl=10, max_size=3, negative_ttl=5, max_stale=20, clock=clock)
+    calls = list()
+    version = [1]
+
+    def lookup(x):
+        calls.append(x)
+        if x == 'bad':
+            return task.deferLater(clock, 1, lambda: None)
+        if x == 'error':
+            return task.deferLater(clock, 1, lambda: 1 / 0)
+        return task.deferLater(clock, 1, lambda: (x, version[0]))
+
+    results = list()
+
+    def get(x):
+        cache.get(x, lookup, x).addCallbacks(results.append, lambda f: results.append(f.type))
+
+    # misses are coalesced and then hit
+    get('a'), get('a')
+    clock.advance(1)
+    get('a')
+    assert results == [('a', 1)] * 3 and calls == ['a'], (results, calls)
+
+    # stale results are served immediately and refreshed in the background
+    version[0] = 2
+    clock.advance(10)
+    get('a')
+    assert results[-1] == ('a', 1) and calls == ['a', 'a']
+    clock.advance(1)
+    get('a')
+    assert results[-1] == ('a', 2)
+
+    # too stale to serve
+    clock.advance(31)
+    get('a')
+    assert results[-1] == ('a', 2)
+    clock.advance(1)
+    assert results[-1] == ('a', 2) and calls == ['a'] * 3
+
+    # negative results are cached for negative_ttl, failures aren't cached
+    get('bad'), clock.advance(1), get('bad')
+    assert results[-2:] == [None, None] and calls.count('bad') == 1
+    clock.advance(5)
+    get('bad'), clock.advance(1)
+    assert calls.count('bad') == 2
+    get('error'), clock.advance(1), get('error'), clock.advance(1)
+    assert results[-2:] == [ZeroDivisionError] * 2 and calls.count('error') == 2
+
+    # least recently used results are evicted
+    for x in ('b', 'c', 'd'):
+        get(x)
+    clock.advance(1)
+    assert 'a' not in cache.entries and len(cache) == 3 and cache.evictions >= 1
+    print(cache)
+
+
+if __name__ == '__main__':
+    main()
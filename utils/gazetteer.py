@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import re
+import mmap
+import unicodedata
+from collections import namedtuple
+
+from twobitbot.utils import tzfile
+
+log = logging.getLogger(__name__)
+
+# The gazetteer index is a text file of "key<TAB>name<TAB>lat<TAB>lng<TAB>tz" lines sorted by key, where key is a
+# normalized place name and tz a tz database zone name. It is searched in place by bisecting the memory mapped file.
+# It is built from the tz database's zone.tab and iso3166.tab (zone cities, and countries with a single zone) and
+# from places.tsv, hand picked "name<TAB>lat<TAB>lng<TAB>tz<TAB>alias|alias" lines with precedence over both:
+#   python -m twobitbot.utils.gazetteer build
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteer.tsv')
+PLACES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'places.tsv')
+
+# names that mean quite different places (e.g. the country or the US state), left to the Google APIs
+AMBIGUOUS = frozenset(['georgia', 'washington'])
+
+Place = namedtuple('Place', ['name', 'lat', 'lng', 'tz'])
+
+_NON_ALNUM = re.compile(r'[^a-z0-9]+')
+
+
+def normalize(location):
+    """Key for a place name: lowercase ascii words, without accents or punctuation."""
+    if isinstance(location, str):
+        location = location.decode('utf-8', 'replace')
+    key = _NON_ALNUM.sub(' ', unicodedata.normalize('NFKD', location).encode('ascii', 'ignore').lower()).strip()
+    if not key:
+        # e.g. names in non-latin scripts
+        key = ' '.join(location.lower().split()).encode('utf-8')
+    return key
+
+
+def _format_line(key, place):
+    return '\t'.join([key, place.name.encode('utf-8') if isinstance(place.name, unicode) else place.name,
+                      '{:.4f}'.format(place.lat), '{:.4f}'.format(place.lng), place.tz]) + '\n'
+
+
+def _parse_line(line):
+    key, name, lat, lng, tz = line.rstrip('\n').split('\t')
+    return key, Place(name.decode('utf-8'), float(lat), float(lng), tz)
+
+
+class Gazetteer(object):
+    def __init__(self, index_path=INDEX_PATH, cache_path=None, tzdir=None):
+        """
+        Resolves place names to coordinates and tz database zones without any API calls.
+        index_path: sorted gazetteer index, see above.
+        cache_path: file that places looked up elsewhere (i.e. Google) are appended to with remember(), in the
+            same format as the index but unsorted. It is loaded into memory on startup.
+        tzdir: tz database directory, by default the system one.
+        """
+        self.tzdir = tzdir or tzfile.find_tzdir()
+        self._index = None
+        self._index_file = None
+        try:
+            self._index_file = open(index_path, 'rb')
+            if os.fstat(self._index_file.fileno()).st_size:
+                self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            log.warn("Could not open the gazetteer index {}".format(index_path), exc_info=True)
+
+        self.cache_path = cache_path
+        self.cache = dict()
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                for line in f:
+                    try:
+                        key, place = _parse_line(line)
+                    except ValueError:
+                        log.warn("Skipping bad line in {}: {!r}".format(cache_path, line))
+                    else:
+                        self.cache[key] = place
+            log.info("Loaded {} cached places from {}".format(len(self.cache), cache_path))
+
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+
+    def _search(self, key):
+        """Bisect the index for the line with key, by seeking to the middle of the search range and using the line
+        that contains it."""
+        index = self._index
+        lo, hi = 0, len(index)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = index.rfind('\n', lo, mid) + 1 or lo
+            end = index.find('\n', start, hi)
+            if end == -1:
+                end = hi
+            line_key = index[start:index.find('\t', start, end)]
+            if line_key < key:
+                lo = end + 1
+            elif line_key > key:
+                hi = start
+            else:
+                return index[start:end]
+
+    def lookup(self, location):
+        """Find a place by name in the local cache or index. Return value: Place or None"""
+        key = normalize(location)
+        place = self.cache.get(key)
+        if place is None and self._index is not None and key and '\t' not in key:
+            line = self._search(key)
+            if line is not None:
+                place = _parse_line(line)[1]
+        if place is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return place
+
+    def remember(self, location, place):
+        """Add a place found elsewhere to the persistent cache, so future lookups of location are local."""
+        key = normalize(location)
+        if not key or key in self.cache:
+            return
+        self.cache[key] = place
+        if self.cache_path:
+            try:
+                with open(self.cache_path, 'ab') as f:
+                    f.write(_format_line(key, place))
+            except IOError:
+                log.warn("Could not save place {} to {}".format(key, self.cache_path), exc_info=True)
+
+    def utcoffset(self, place, timestamp):
+        """UTC offset in seconds at a place at a UTC timestamp, or None if its timezone isn't available."""
+        return tzfile.utcoffset(place.tz, timestamp, self.tzdir)
+
+
+def _parse_coordinates(iso6709):
+    """Parse zone.tab coordinates, +-DDMM[SS]+-DDDMM[SS]."""
+    match = re.match(r'^([+-])(\d{2})(\d{2})(\d{2})?([+-])(\d{3})(\d{2})(\d{2})?$', iso6709)
+    sign, d, m, s, lng_sign, lng_d, lng_m, lng_s = match.groups()
+    lat = (int(d) + int(m)/60.0 + int(s or 0)/3600.0) * (-1 if sign == '-' else 1)
+    lng = (int(lng_d) + int(lng_m)/60.0 + int(lng_s or 0)/3600.0) * (-1 if lng_sign == '-' else 1)
+    return lat, lng
+
+
+def _read_tab(path):
+    with open(path, 'rb') as f:
+        return [line.rstrip('\n').split('\t') for line in f if line.strip() and not line.startswith('#')]
+
+
+def build_index(tzdir=None, places_path=PLACES_PATH, index_path=INDEX_PATH):
+    """Regenerate the gazetteer index. Return value: number of keys written"""
+    tzdir = tzdir or tzfile.find_tzdir()
+    countries = dict((row[0], row[1].decode('utf-8')) for row in _read_tab(os.path.join(tzdir, 'iso3166.tab')))
+    zones = _read_tab(os.path.join(tzdir, 'zone.tab'))
+
+    index = dict()
+
+    def add(name, place):
+        key = normalize(name)
+        if key and key not in AMBIGUOUS and key not in index:
+            index[key] = place
+
+    with open(places_path, 'rb') as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            name, lat, lng, tz, aliases = (line.rstrip('\n').split('\t') + [''])[:5]
+            place = Place(name.decode('utf-8'), float(lat), float(lng), tz)
+            for alias in [name, name.split(',')[0]] + aliases.split('|'):
+                add(alias, place)
+
+    zones_per_country = dict()
+    for row in zones:
+        zones_per_country[row[0]] = zones_per_country.get(row[0], 0) + 1
+    for row in zones:
+        code, coordinates, tz = row[:3]
+        city = tz.rsplit('/', 1)[-1].replace('_', ' ')
+        place = Place(u'{}, {}'.format(city, countries.get(code, code)), *_parse_coordinates(coordinates), tz=tz)
+        add(city, place)
+    for row in zones:
+        code, coordinates, tz = row[:3]
+        if zones_per_country[code] == 1 and code in countries:
+            place = Place(countries[code], *_parse_coordinates(coordinates), tz=tz)
+            add(countries[code], place)
+            # e.g. "Britain (UK)"
+            add(countries[code].split('(')[0], place)
+
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for key in sorted(index):
+            f.write(_format_line(key, index[key]))
+    os.rename(tmp_path, index_path)
+    return len(index)
+
+
+def main():
+    import argparse
+    import time
+    import random
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build the gazetteer index or benchmark lookups.")
+    parser.add_argument('mode', nargs='?', choices=['check', 'build'], default='check')
+    args = parser.parse_args()
+
+    if args.mode == 'build':
+        print("Wrote {} places to {}".format(build_index(), INDEX_PATH))
+        return
+
+    cache_path = os.path.join(tempfile.mkdtemp(), 'locations.tsv')
+    gazetteer = Gazetteer(cache_path=cache_path)
+    with open(INDEX_PATH, 'rb') as f:
+        lines = [_parse_line(line) for line in f]
+
+    # every key can be found, and keys that sort right after them can't
+    for key, place in lines:
+        assert gazetteer.lookup(key) == place, key
+        assert gazetteer._search(key + ' ') is None, key
+    assert gazetteer.lookup(' New  York, NY ') == gazetteer.lookup('new york ny')
+    assert gazetteer.lookup(u'Zürich') is not None
+    assert gazetteer.lookup('nowhere in particular') is None
+    missing = sorted(set(place.tz for _, place in lines if gazetteer.utcoffset(place, time.time()) is None))
+    print("{} places, {} timezones not in the tz database: {}".format(len(lines), len(missing), ', '.join(missing)))
+
+    # the persistent cache
+    gazetteer.remember('Springfield, IL', Place(u'Springfield, IL, USA', 39.78, -89.65, 'America/Chicago'))
+    assert Gazetteer(cache_path=cache_path).lookup('springfield il').tz == 'America/Chicago'
+
+    random.seed(22)
+    queries = [random.choice(lines)[0] for _ in xrange(20000)]
+    start = time.time()
+    for query in queries:
+        place = gazetteer.lookup(query)
+        gazetteer.utcoffset(place, start)
+    elapsed = time.time() - start
+    print("{:.1f}us per lookup with offset".format(elapsed / len(queries) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,18 +2,32 @@
 
 import logging
 import datetime
+import calendar
 import treq
 
 from twisted.internet import defer
 
 from twobitbot.utils.misc import now_in_utc_secs
+from twobitbot.utils.gazetteer import Place, normalize
+from twobitbot.utils.asynccache import AsyncCache
 
 log = logging.getLogger(__name__)
 
-# todo raise errors on failure...
+# Places don't move, but a failed lookup may be an API problem rather than a bad location, so don't remember those
+# for long. Concurrent lookups of the same thing share one API call.
+geocode_cache = AsyncCache('geocode', ttl=7*24*60*60, max_size=1000, negative_ttl=10*60)
+# UTC offsets only change on multiples of 15 minutes, so timezones are looked up per 15 minute bucket
+TIMEZONE_BUCKET = 15*60
+timezone_cache = AsyncCache('timezone', ttl=TIMEZONE_BUCKET, max_size=1000, negative_ttl=60, max_stale=0)
+caches = (geocode_cache, timezone_cache)
+
+
+class GoogleAPIError(Exception):
+    """A Google API request failed, as opposed to finding nothing. These aren't cached."""
+
 
 @defer.inlineCallbacks
-def lookup_localized_time(location, utc_time, google_api_key=''):
+def lookup_localized_time(location, utc_time, google_api_key='', gazetteer=None):
     """
     Lookup the time in a location.
     :param location: location name
@@ -25,23 +39,37 @@ def lookup_localized_time(location, utc_time, google_api_key=''):
     :param google_api_key: optional API key for Google API calls
     :type google_api_key: str
 
+    :param gazetteer: optional local place lookup, tried before the Google APIs. Places found with Google
+        are added to its cache.
+    :type gazetteer: twobitbot.utils.gazetteer.Gazetteer
+
     :return: a dict containing keys 'time' which is localized time as a datetime object,
-            and 'location' which is the location name returned by Google.
+            and 'location' which is the location name returned by Google, or None if the location wasn't found.
     @rtype: defer.Deferred
+    :raise GoogleAPIError: if the location had to be looked up with Google and that failed
     """
+    timestamp = calendar.timegm(utc_time.utctimetuple())
+    if gazetteer is not None:
+        place = gazetteer.lookup(location)
+        if place is not None:
+            offset = gazetteer.utcoffset(place, timestamp)
+            if offset is not None:
+                defer.returnValue({'time': utc_time+datetime.timedelta(seconds=offset), 'location': place.name})
+
     geocode = yield lookup_geocode(location, google_api_key)
     if geocode:
-        tz = yield lookup_timezone(geocode, google_api_key)
+        tz = yield lookup_timezone(geocode, google_api_key, timestamp)
         try:
-            new_time = utc_time+datetime.timedelta(seconds=tz)
+            new_time = utc_time+datetime.timedelta(seconds=tz['offset'])
         except TypeError:
             log.error("Encountered error changing timezone with sec offset", exc_info=True)
         else:
+            if gazetteer is not None and tz['tz']:
+                gazetteer.remember(location, Place(geocode['loc'], geocode['lat'], geocode['lng'], tz['tz']))
             ret = {'time': new_time, 'location': geocode['loc']}
             defer.returnValue(ret)
 
 
-@defer.inlineCallbacks
 def lookup_geocode(location, api_key=''):
     """
     Determine the lat/long coordinates for a location name.
@@ -51,54 +79,76 @@ def lookup_geocode(location, api_key=''):
     :type api_key: str
 
     :return: a dict with keys 'lat', 'lng', 'loc' that contain
-     the lat/long coordinates and placename for the location.
+     the lat/long coordinates and placename for the location, or None if there is no such place.
     :rtype: defer.Deferred
+    :raise GoogleAPIError: if the API request failed
     """
+    return geocode_cache.get((normalize(location), api_key), _lookup_geocode, location, api_key)
+
+
+@defer.inlineCallbacks
+def _request(api, url, params):
+    """GET a Google API and return the response's JSON. Any failure is raised as a GoogleAPIError."""
     try:
-        res = yield treq.get("http://maps.googleapis.com/maps/api/geocode/json",
-                             params={'address': location, 'sensor': 'false', 'key': api_key})
-        if res and res.code == 200:
-            data = yield treq.json_content(res)
-            if data['status'] == 'OK':
-                # API returned at least one geocode
-                ret = data['results'][0]['geometry']['location']
-                ret['loc'] = data['results'][0]['formatted_address']
-                defer.returnValue(ret)
-            else:
-                log.warn("Bad status response from Google Geocode API: %s" % (data['status']))
-        elif res is not None:
-            log.warn("Bad HTTP status from Google Geocode API: %s" % (res.code))
-    except TypeError:
-        log.warn("Bad location passed to lookup_geocode", exc_info=True)
+        res = yield treq.get(url, params=params)
+        if res.code != 200:
+            raise GoogleAPIError("Bad HTTP status from Google {} API: {}".format(api, res.code))
+        data = yield treq.json_content(res)
+    except (GoogleAPIError, defer.CancelledError):
+        raise
+    except Exception as e:
+        raise GoogleAPIError("Google {} API request failed: {!r}".format(api, e))
+    defer.returnValue(data)
+
+
+def _check_status(api, data):
+    """Return True if a Google API response has results, False if there were none, or raise GoogleAPIError."""
+    status = data.get('status')
+    if status == 'OK':
+        return True
+    elif status == 'ZERO_RESULTS':
+        return False
+    raise GoogleAPIError("Bad status response from Google {} API: {} {}".format(
+        api, status, data.get('error_message', '')))
 
 
 @defer.inlineCallbacks
-def lookup_timezone(loc, api_key=''):
+def _lookup_geocode(location, api_key):
+    data = yield _request('Geocode', "http://maps.googleapis.com/maps/api/geocode/json",
+                          {'address': location, 'sensor': 'false', 'key': api_key})
+    if _check_status('Geocode', data):
+        # API returned at least one geocode
+        ret = data['results'][0]['geometry']['location']
+        ret['loc'] = data['results'][0]['formatted_address']
+        defer.returnValue(ret)
+
+
+def lookup_timezone(loc, api_key='', timestamp=None):
     """
     Determine the timezone of a lat/long pair.
 
     @param loc: lat/long coordinates of a location
     @type loc: dict
     @type api_key: str
+    @param timestamp: UTC timestamp to find the offset at, by default now
+    @type timestamp: int
 
-    @rtype: defer.Deferred yielding a second offset representing the timezone
+    @rtype: defer.Deferred yielding a dict with keys 'offset', the second offset representing the timezone,
+        and 'tz', its tz database name (if Google returned one), or None if Google has no timezone there
+    :raise GoogleAPIError: if the API request failed
     """
-    try:
-        res = yield treq.get(("https://maps.googleapis.com/maps/api/timezone/json"),
-                             params={'location': str(loc['lat']) + ',' + str(loc['lng']),
-                                     'timestamp': str(now_in_utc_secs()), 'sensor': 'false', 'key': api_key})
-        if res and res.code == 200:
-            data = yield treq.json_content(res)
-            if data['status'] == 'OK':
-                # API returned timezone info. What we care about: rawOffset
-                defer.returnValue(int(data['rawOffset'])+int(data['dstOffset']))
-            else:
-                log.warn("Bad status response from Google Geocode API: %s" % (data['status']))
-        elif res is not None:
-            log.warn("Bad HTTP status from Google Timezone API: %s" % (res.code))
-    except TypeError:
-        log.warn("Bad lat/long parameter passed to lookup_timezone: %s" % (loc), exc_info=True)
+    timestamp = (timestamp or now_in_utc_secs()) // TIMEZONE_BUCKET * TIMEZONE_BUCKET
+    return timezone_cache.get((loc['lat'], loc['lng'], timestamp, api_key), _lookup_timezone, loc, api_key, timestamp)
+
 
+@defer.inlineCallbacks
+def _lookup_timezone(loc, api_key, timestamp):
+    data = yield _request('Timezone', "https://maps.googleapis.com/maps/api/timezone/json",
+                          {'location': str(loc['lat']) + ',' + str(loc['lng']), 'timestamp': str(timestamp),
+                           'sensor': 'false', 'key': api_key})
+    if _check_status('Timezone', data):
+        # API returned timezone info. What we care about: rawOffset
+        defer.returnValue({'offset': int(data['rawOffset'])+int(data['dstOffset']), 'tz': data.get('timeZoneId')})
 
 
 def main():
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class P2Quantile(object):
+    """
+    Streaming estimate of a quantile with the P-square algorithm (Jain & Chlamtac, 1985).
+
+    Only five markers are kept, so memory is constant and adding an observation is O(1).
+    """
+
+    def __init__(self, p):
+        """
+        :param p: quantile to estimate, between 0 and 1
+        :type p: float
+        """
+        if not 0 < p < 1:
+            raise ValueError("Quantile must be between 0 and 1, not {}".format(p))
+        self.p = p
+        self.count = 0
+        # marker heights, and their actual and desired positions (1-based)
+        self._heights = list()
+        self._positions = [1, 2, 3, 4, 5]
+        self._desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self._increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        self.count += 1
+        heights = self._heights
+        if self.count <= 5:
+            heights.append(x)
+            heights.sort()
+            return
+
+        positions = self._positions
+        # find the cell x falls in, extending the extreme markers if needed
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= heights[k + 1]:
+                k += 1
+
+        for i in xrange(k + 1, 5):
+            positions[i] += 1
+        for i in xrange(5):
+            self._desired[i] += self._increments[i]
+
+        # nudge the middle markers towards their desired positions
+        for i in xrange(1, 4):
+            d = self._desired[i] - positions[i]
+            if (d >= 1 and positions[i + 1] - positions[i] > 1) or (d <= -1 and positions[i - 1] - positions[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self._linear(i, d)
+                heights[i] = height
+                positions[i] += d
+
+    def value(self):
+        """Return the current estimate, or None if nothing has been observed."""
+        if not self.count:
+            return None
+        if self.count <= 5:
+            return self._heights[int(round(self.p * (self.count - 1)))]
+        return self._heights[2]
+
+    def _parabolic(self, i, d):
+        q, n = self._heights, self._positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                                                   (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def _linear(self, i, d):
+        q, n = self._heights, self._positions
+        return q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+
+
+class RollingQuantiles(object):
+    """
+    Estimates of several quantiles over a rolling time horizon, in constant memory.
+
+    Observations go into P2Quantile estimators for the current half of the horizon. When it is over they
+    become the previous half and fresh estimators are started. Estimates are the count-weighted average
+    of both halves, so they reflect roughly the last horizon worth of data.
+    """
+
+    def __init__(self, percentiles, horizon_ms):
+        """
+        :param percentiles: percentiles to estimate, e.g. (50, 90, 99.9)
+        :param horizon_ms: how far back observations are taken into account
+        """
+        self.percentiles = tuple(percentiles)
+        self.horizon_ms = horizon_ms
+        self._current = self._new_epoch()
+        self._previous = None
+        self._epoch_start = None
+
+    @property
+    def count(self):
+        """Number of observations the estimates are currently based on."""
+        count = self._current[self.percentiles[0]].count
+        if self._previous:
+            count += self._previous[self.percentiles[0]].count
+        return count
+
+    def add(self, x, timestamp):
+        """
+        :param timestamp: time of the observation in ms
+        """
+        if self._epoch_start is None:
+            self._epoch_start = timestamp
+        elif timestamp - self._epoch_start >= self.horizon_ms / 2:
+            self._previous = self._current
+            self._current = self._new_epoch()
+            self._epoch_start = timestamp
+        for estimator in self._current.itervalues():
+            estimator.add(x)
+
+    def value(self, percentile):
+        """Return the estimate for one of the tracked percentiles, or None if nothing has been observed."""
+        total = weighted = 0
+        for epoch in (self._current, self._previous):
+            if epoch:
+                estimator = epoch[percentile]
+                if estimator.count:
+                    total += estimator.count
+                    weighted += estimator.value() * estimator.count
+        return weighted / total if total else None
+
+    def _new_epoch(self):
+        return dict((pct, P2Quantile(pct / 100)) for pct in self.percentiles)
+
+
+def main():
+    """Compare P2Quantile estimates against exact quantiles of a skewed distribution."""
+    import random
+
+    random.seed(0)
+    data = [random.lognormvariate(0, 1.5) for _ in xrange(200000)]
+    exact = sorted(data)
+    for pct in (50, 90, 99, 99.9):
+        estimator = P2Quantile(pct / 100)
+        for x in data:
+            estimator.add(x)
+        print("p{:<5} exact {:>10.3f}  P2 {:>10.3f}".format(pct, exact[int(len(exact) * pct / 100)], estimator.value()))
+
+
+if __name__ == '__main__':
+    main()
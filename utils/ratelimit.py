@@ -20,10 +20,12 @@ class BaseUserRateLimiter(object):
         self.users[user]['since_last'] = self._get_now() - self.users[user]['last']
         return self._is_limited_predicate(self.users[user])
 
-    def user_event_now(self, user):
+    def user_event_now(self, user, cost=1):
+        """cost: how many events this one counts as."""
         if user not in self.users:
             self.users[user] = {'last': 0, 'since_last': 0}
         self.users[user]['last'] = self._get_now()
+        self.users[user]['cost'] = cost
         self._saw_user_event(self.users[user])
 
     def _is_limited_predicate(self, user):
@@ -56,9 +58,9 @@ class ExponentialRateLimiter(BaseUserRateLimiter):
 
     def _saw_user_event(self, user):
         if user['since_last'] > self.reset_after or 'count' not in user:
-            user['count'] = self.base
+            user['count'] = self.base + user['cost'] - 1
         else:
-            user['count'] += 1
+            user['count'] += user['cost']
 
 
 class ConstantRateLimiter(BaseUserRateLimiter):
@@ -68,7 +70,7 @@ class ConstantRateLimiter(BaseUserRateLimiter):
         self.delay = delay
 
     def _is_limited_predicate(self, user):
-        if user['since_last'] < self.delay:
+        if user['since_last'] < self.delay * user['cost']:
             return True
         return False
 
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import logging
+
+from twisted.internet import defer
+from twisted.python import failure
+
+log = logging.getLogger(__name__)
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls of Deferred-returning functions: while a call with some key is in flight, further
+    calls with the same key wait for its result instead of making their own upstream call.
+    Every caller gets its own Deferred, which fires with the shared result or failure. Cancelling a caller's
+    Deferred only cancels that caller, and the upstream call is cancelled once no callers are left waiting.
+    Callers share the result object, so they shouldn't modify it.
+    """
+    def __init__(self, name=''):
+        self.name = name
+        self._flights = dict()
+        self.calls = 0
+        self.upstream_calls = 0
+
+    @property
+    def saved(self):
+        """Upstream calls saved by coalescing."""
+        return self.calls - self.upstream_calls
+
+    def in_flight(self, key):
+        return key in self._flights
+
+    def call(self, key, f, *args, **kwargs):
+        """Call f(*args, **kwargs) unless a call with key is already in flight.
+        Return value: Deferred firing with the result"""
+        self.calls += 1
+        flight = self._flights.get(key)
+        if flight is None:
+            self.upstream_calls += 1
+            upstream = defer.maybeDeferred(f, *args, **kwargs)
+            if upstream.called:
+                # finished synchronously, there's nothing to wait for
+                return upstream
+            flight = self._flights[key] = _Flight(upstream, lambda: self._land(key, flight))
+        else:
+            log.debug("Coalesced {} call {!r}, {} upstream calls saved".format(self.name, key, self.saved))
+        return flight.wait()
+
+    def _land(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def __str__(self):
+        return "{}{} calls, {} upstream, {} saved".format(self.name + ': ' if self.name else '', self.calls,
+                                                          self.upstream_calls, self.saved)
+
+
+class _Flight(object):
+    def __init__(self, upstream, on_landed):
+        self.upstream = upstream
+        self.waiters = list()
+        self.on_landed = on_landed
+        upstream.addBoth(self._landed)
+
+    def wait(self):
+        d = defer.Deferred(canceller=self._cancel)
+        self.waiters.append(d)
+        return d
+
+    def _cancel(self, d):
+        self.waiters.remove(d)
+        if not self.waiters:
+            self.on_landed()
+            self.upstream.cancel()
+
+    def _landed(self, result):
+        self.on_landed()
+        waiters, self.waiters = self.waiters, list()
+        for d in waiters:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        # every waiter got any failure, so don't log it as unhandled here
+
+
+def main():
+    from twisted.internet import task
+
+    logging.basicConfig(level=logging.INFO)
+    clock = task.Clock()
+    flights = SingleFlight('test')
+    upstream = list()
+
+    def lookup(x):
+        upstream.append(x)
+        return task.deferLater(clock, 1, lambda: x * 2)
+
+    results = list()
+    for x in (1, 1, 2, 1):
+        flights.call(x, lookup, x).addCallback(results.append)
+    clock.advance(1)
+    assert sorted(results) == [2, 2, 2, 4] and upstream == [1, 2], (results, upstream)
+    assert not flights.in_flight(1)
+    flights.call(1, lookup, 1)
+    assert upstream == [1, 2, 1]
+    clock.advance(1)
+
+    # failures reach every caller
+    def fail():
+        return task.deferLater(clock, 1, lambda: 1 / 0)
+    errors = list()
+    for _ in xrange(3):
+        flights.call('fail', fail).addErrback(lambda f: errors.append(f.type))
+    clock.advance(1)
+    assert errors == [ZeroDivisionError] * 3, errors
+
+    # cancelling one caller leaves the others waiting, cancelling all of them cancels the upstream call
+    d1, d2 = flights.call('slow', lookup, 5), flights.call('slow', lookup, 5)
+    d1.addErrback(lambda f: errors.append(f.type))
+    d1.cancel()
+    assert errors[-1] is defer.CancelledError and flights.in_flight('slow')
+    d2.addErrback(lambda f: None)
+    d2.cancel()
+    assert not clock.getDelayedCalls() and not flights.in_flight('slow')
+
+    # synchronous results aren't shared
+    assert flights.call('sync', lambda: 3).result == 3
+    print(flights)
+
+
+if __name__ == '__main__':
+    main()
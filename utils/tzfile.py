@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import re
+import struct
+import calendar
+import datetime
+from bisect import bisect_right
+
+log = logging.getLogger(__name__)
+
+# Reads the system tz database (TZif files, see tzfile(5)) so UTC offsets, including daylight saving time,
+# can be computed locally without a timezone API.
+
+TZDIRS = ('/usr/share/zoneinfo', '/usr/lib/zoneinfo', '/usr/share/lib/zoneinfo', '/etc/zoneinfo')
+
+_HEADER = struct.Struct('>4sc15x6l')
+_TTINFO = struct.Struct('>lBB')
+
+# POSIX TZ strings as found in TZif footers, e.g. 'EST5EDT,M3.2.0,M11.1.0' or '<+1030>-10:30<+11>-11,M10.1.0,M4.1.0'
+_TZ_NAME = r'(?:[A-Za-z]{3,}|<[A-Za-z0-9+-]+>)'
+_TZ_OFFSET = r'[+-]?\d{1,3}(?::\d{1,2}(?::\d{1,2})?)?'
+_TZ_RULE = r'(?:J\d{1,3}|\d{1,3}|M\d{1,2}\.\d\.\d)(?:/' + _TZ_OFFSET + ')?'
+_TZ_STRING = re.compile(r'^{0}({1})(?:{0}({1})?(?:,({2}),({2}))?)?$'.format(_TZ_NAME, _TZ_OFFSET, _TZ_RULE))
+
+
+def _parse_offset(s):
+    """Seconds in a [+-]hh[:mm[:ss]] string."""
+    sign = -1 if s.startswith('-') else 1
+    parts = [int(p) for p in s.lstrip('+-').split(':')]
+    parts += [0] * (3 - len(parts))
+    return sign * (parts[0]*3600 + parts[1]*60 + parts[2])
+
+
+class PosixRule(object):
+    """A POSIX TZ string, which tz files use for times after their last listed transition."""
+    def __init__(self, tz_string):
+        match = _TZ_STRING.match(tz_string)
+        if not match:
+            raise ValueError("Unsupported TZ string {!r}".format(tz_string))
+        std, dst, start, end = match.groups()
+        # POSIX offsets are hours west of UTC
+        self.std_offset = -_parse_offset(std)
+        self.dst_offset = -_parse_offset(dst) if dst else self.std_offset + 3600
+        self.has_dst = start is not None
+        if self.has_dst:
+            self.start = self._parse_rule(start)
+            self.end = self._parse_rule(end)
+
+    @staticmethod
+    def _parse_rule(rule):
+        date, _, time = rule.partition('/')
+        return date, _parse_offset(time) if time else 2*3600
+
+    @staticmethod
+    def _rule_day(date, year):
+        """Day of the year (0-based) that a rule date falls on."""
+        if date.startswith('M'):
+            month, week, weekday = [int(p) for p in date[1:].split('.')]
+            # weekday 0 is Sunday in TZ strings, python weeks start on Monday
+            first = (datetime.date(year, month, 1).weekday() + 1) % 7
+            day = 1 + (weekday - first) % 7 + (week - 1) * 7
+            if day > calendar.monthrange(year, month)[1]:
+                # week 5 means the last such weekday of the month
+                day -= 7
+            return datetime.date(year, month, day).timetuple().tm_yday - 1
+        elif date.startswith('J'):
+            # 1-365, February 29th is never counted
+            day = int(date[1:]) - 1
+            return day + 1 if calendar.isleap(year) and day >= 59 else day
+        else:
+            return int(date)
+
+    def _transition(self, rule, year, offset):
+        """UTC timestamp of a rule's transition in a year, where offset is the UTC offset in effect before it."""
+        date, time = rule
+        return calendar.timegm((year, 1, 1, 0, 0, 0)) + self._rule_day(date, year)*86400 + time - offset
+
+    def utcoffset(self, timestamp):
+        if not self.has_dst:
+            return self.std_offset
+        year = datetime.datetime.utcfromtimestamp(timestamp + self.std_offset).year
+        start = self._transition(self.start, year, self.std_offset)
+        end = self._transition(self.end, year, self.dst_offset)
+        if start < end:
+            in_dst = start <= timestamp < end
+        else:
+            # southern hemisphere, DST spans the new year
+            in_dst = not end <= timestamp < start
+        return self.dst_offset if in_dst else self.std_offset
+
+
+class TimeZone(object):
+    def __init__(self, name, transitions, offsets, rule=None):
+        """transitions: sorted UTC timestamps at which the offset changes.
+        offsets: UTC offsets in seconds, one before the first transition and one after each transition.
+        rule: PosixRule for times after the last transition."""
+        self.name = name
+        self.transitions = transitions
+        self.offsets = offsets
+        self.rule = rule
+
+    def utcoffset(self, timestamp):
+        """UTC offset in seconds at a UTC timestamp."""
+        if self.rule is not None and (not self.transitions or timestamp >= self.transitions[-1]):
+            return self.rule.utcoffset(timestamp)
+        return self.offsets[bisect_right(self.transitions, timestamp)]
+
+    @classmethod
+    def from_file(cls, name, f):
+        data = f.read()
+        magic, version, isutcnt, isstdcnt, leapcnt, timecnt, typecnt, charcnt = _HEADER.unpack_from(data)
+        if magic != 'TZif':
+            raise ValueError("{} is not a tz file".format(name))
+        time_format, pos = '>{}l', _HEADER.size
+        if version >= '2':
+            # skip the 32-bit data and read the 64-bit version that follows
+            pos += timecnt*5 + typecnt*6 + charcnt + leapcnt*8 + isstdcnt + isutcnt
+            magic, version, isutcnt, isstdcnt, leapcnt, timecnt, typecnt, charcnt = _HEADER.unpack_from(data, pos)
+            time_format, pos = '>{}q', pos + _HEADER.size
+        time_struct = struct.Struct(time_format.format(timecnt))
+        transitions = list(time_struct.unpack_from(data, pos))
+        pos += time_struct.size
+        indices = struct.unpack_from('>{}B'.format(timecnt), data, pos)
+        pos += timecnt
+        ttinfos = [_TTINFO.unpack_from(data, pos + i*_TTINFO.size) for i in xrange(typecnt)]
+        pos += typecnt*_TTINFO.size + charcnt + leapcnt*(12 if time_format.endswith('q') else 8) + isstdcnt + isutcnt
+
+        # before the first transition the first standard time type applies
+        initial = next((gmtoff for gmtoff, isdst, _ in ttinfos if not isdst), ttinfos[0][0])
+        offsets = [initial] + [ttinfos[i][0] for i in indices]
+
+        rule = None
+        footer = data[pos:].strip('\n')
+        if version >= '2' and footer:
+            try:
+                rule = PosixRule(footer)
+            except ValueError:
+                log.warn("Ignoring the TZ string of {}".format(name), exc_info=True)
+        return cls(name, transitions, offsets, rule)
+
+
+_zones = dict()
+
+
+def find_tzdir():
+    for tzdir in (os.environ.get('TZDIR'),) + TZDIRS:
+        if tzdir and os.path.isdir(tzdir):
+            return tzdir
+
+
+def get_zone(name, tzdir=None):
+    """Load the TimeZone for a tz database name like 'America/New_York', or None if it isn't available."""
+    try:
+        return _zones[name]
+    except KeyError:
+        pass
+    tzdir = tzdir or find_tzdir()
+    zone = None
+    if tzdir and name and not name.startswith(('/', '.')) and '..' not in name:
+        try:
+            with open(os.path.join(tzdir, name), 'rb') as f:
+                zone = TimeZone.from_file(name, f)
+        except (IOError, ValueError, struct.error):
+            log.warn("Could not load timezone {}".format(name), exc_info=True)
+    _zones[name] = zone
+    return zone
+
+
+def utcoffset(name, timestamp, tzdir=None):
+    """UTC offset in seconds of a tz database zone at a UTC timestamp, or None if the zone isn't available."""
+    zone = get_zone(name, tzdir)
+    if zone is not None:
+        return zone.utcoffset(timestamp)
+
+
+def main():
+    """Check offsets against the C library for every zone in zone.tab, around DST changes and far in the future."""
+    import time
+    import random
+
+    logging.basicConfig(level=logging.INFO)
+    tzdir = find_tzdir()
+    if tzdir is None:
+        print("No tz database found")
+        return
+    with open(os.path.join(tzdir, 'zone.tab')) as f:
+        names = [line.split('\t')[2].strip() for line in f if not line.startswith('#')]
+
+    random.seed(22)
+    now = int(time.time())
+    # 32-bit time_t ends in 2038, which is also where older tz files stop listing transitions
+    timestamps = [now + random.randint(-20, 20)*365*86400 + random.randint(0, 365*86400) for _ in xrange(100)]
+    timestamps += [calendar.timegm((year, month, 1, 0, 0, 0)) + hour*3600
+                   for year in (2014, 2037, 2040) for month in (3, 4, 10, 11) for hour in xrange(0, 31*24, 5)]
+    timestamps = [t for t in timestamps if 0 <= t < 2**31 - 1]
+
+    mismatches = 0
+    original_tz = os.environ.get('TZ')
+    for name in names:
+        os.environ['TZ'] = name
+        time.tzset()
+        for t in timestamps:
+            local = time.localtime(t)
+            expected = calendar.timegm(local) - t
+            got = utcoffset(name, t, tzdir)
+            if got != expected:
+                mismatches += 1
+                if mismatches <= 10:
+                    print("{} at {}: got {}, expected {}".format(name, t, got, expected))
+    if original_tz is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = original_tz
+    time.tzset()
+    print("Checked {} zones at {} times each, {} mismatches".format(len(names), len(timestamps), mismatches))
+
+    start = time.time()
+    for t in timestamps:
+        for name in names:
+            utcoffset(name, t)
+    elapsed = time.time() - start
+    print("{:.2f}us per offset lookup".format(elapsed / (len(names)*len(timestamps)) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
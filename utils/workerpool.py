@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+import logging
+
+from twisted.internet import defer
+from twisted.python import threadpool
+
+log = logging.getLogger(__name__)
+
+
+class PoolBusyError(Exception):
+    """A worker pool has as much work as it can queue."""
+
+
+class BoundedWorkerPool(object):
+    def __init__(self, name, size=2, max_queued=4, timeout=20, reactor=None):
+        """
+        A dedicated thread pool for slow blocking calls, e.g. API clients without Twisted support, so they don't
+        tie up the reactor's shared thread pool (used for DNS lookups, adbapi and the like).
+        At most size calls run at once and max_queued more wait for a thread. Calls beyond that fail right away
+        with PoolBusyError. A call that hasn't finished within timeout seconds fails with defer.TimeoutError.
+        Cancelling or timing out a call that hasn't started yet means it never runs. One that is already running
+        can't be interrupted, so it keeps its thread (and counts towards the limit) until it returns.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.name = name
+        self.size = size
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.reactor = reactor
+        self.pool = threadpool.ThreadPool(minthreads=0, maxthreads=size, name=name)
+        self.started = False
+
+        # calls that were submitted but haven't returned, including cancelled and timed out ones
+        self.pending = 0
+        self.completed = 0
+        self.shed = 0
+        self.timeouts = 0
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            self.pool.start()
+            self._shutdown_trigger = self.reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.started:
+            self.started = False
+            self.pool.stop()
+            try:
+                self.reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            except (ValueError, KeyError):
+                # already ran, i.e. this is the shutdown
+                pass
+
+    def submit(self, f, *args, **kwargs):
+        """Call f(*args, **kwargs) in a worker thread. Return value: Deferred firing with the result"""
+        if self.pending >= self.size + self.max_queued:
+            self.shed += 1
+            log.warn("{} worker pool is busy, shed a call ({} shed so far)".format(self.name, self.shed))
+            return defer.fail(PoolBusyError("{} is busy".format(self.name)))
+        self.start()
+
+        call = _Call()
+        d = defer.Deferred(canceller=lambda _: call.cancel())
+        call.timer = self.reactor.callLater(self.timeout, self._timed_out, d, call)
+        self.pending += 1
+
+        def run():
+            if call.cancelled:
+                return None
+            return f(*args, **kwargs)
+
+        def returned(success, result):
+            self.reactor.callFromThread(self._returned, d, call, success, result)
+
+        self.pool.callInThreadWithCallback(returned, run)
+        return d
+
+    def _returned(self, d, call, success, result):
+        self.pending -= 1
+        if call.timer.active():
+            call.timer.cancel()
+        if call.cancelled:
+            return
+        self.completed += 1
+        if success:
+            d.callback(result)
+        else:
+            d.errback(result)
+
+    def _timed_out(self, d, call):
+        call.cancelled = True
+        self.timeouts += 1
+        log.warn("{} call timed out after {}s ({} timeouts so far)".format(self.name, self.timeout, self.timeouts))
+        d.errback(defer.TimeoutError("{} call took longer than {}s".format(self.name, self.timeout)))
+
+    def __str__(self):
+        running = min(self.pending, self.size)
+        return "{} {} running, {} queued, {} completed, {} shed, {} timed out".format(
+            self.name, running, self.pending - running, self.completed, self.shed, self.timeouts)
+
+
+class _Call(object):
+    def __init__(self):
+        self.cancelled = False
+        self.timer = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self.timer.active():
+            self.timer.cancel()
+
+
+def main():
+    import time
+    import threading
+    from twisted.internet import reactor
+
+    logging.basicConfig(level=logging.INFO)
+    pool = BoundedWorkerPool('test', size=2, max_queued=2, timeout=0.5)
+    ran = list()
+    release = threading.Event()
+
+    def slow(x):
+        release.wait()
+        ran.append(x)
+        return x
+
+    outcomes = dict()
+
+    def track(d, x):
+        d.addCallbacks(lambda result: outcomes.__setitem__(x, result),
+                       lambda f: outcomes.__setitem__(x, f.type.__name__))
+
+    @defer.inlineCallbacks
+    def check():
+        # 2 run, 2 queue and the rest are shed
+        ds = [pool.submit(slow, x) for x in xrange(6)]
+        for x, d in enumerate(ds):
+            track(d, x)
+        assert outcomes == {4: 'PoolBusyError', 5: 'PoolBusyError'}, outcomes
+        ds[3].cancel()
+        assert outcomes[3] == 'CancelledError'
+
+        # the running and queued calls time out
+        yield task_sleep(0.6)
+        assert all(outcomes[x] == 'TimeoutError' for x in xrange(3)), outcomes
+        assert pool.pending == 4
+        release.set()
+        yield task_sleep(0.2)
+        # only the calls that had started ran, and the pool has room again
+        assert sorted(ran) == [0, 1] and pool.pending == 0, (ran, pool.pending)
+
+        result = yield pool.submit(lambda: 42)
+        assert result == 42
+        try:
+            yield pool.submit(lambda: 1 / 0)
+        except ZeroDivisionError:
+            pass
+        else:
+            raise AssertionError("expected the call's exception")
+
+        # round trip of quick calls
+        start = time.time()
+        results = yield defer.gatherResults([pool.submit(lambda x: x, x) for x in xrange(4)])
+        assert results == range(4)
+        print("{}, last batch in {:.1f}ms".format(pool, (time.time() - start) * 1e3))
+
+    def task_sleep(seconds):
+        d = defer.Deferred()
+        reactor.callLater(seconds, d.callback, None)
+        return d
+
+    def done(result):
+        pool.stop()
+        reactor.stop()
+        return result
+
+    reactor.callWhenRunning(lambda: check().addErrback(lambda f: f.printTraceback()).addBoth(done))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()